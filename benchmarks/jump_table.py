@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+
+# Shows that the cost of one loop iteration doesn't depend on how much program comes before the loop.
+# Usage: benchmarks/jump_table.py [path/to/ly.py]
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ly = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), os.pardir, "ly.py")
+iterations = 20000
+repeats = 3
+
+
+def run(padding, count):
+    return min(run_once(padding, count) for _ in range(repeats))
+
+
+def run_once(padding, count):
+    # a countdown loop at the very end of the program, after `padding` no-op characters
+    with tempfile.NamedTemporaryFile("w", suffix=".ly", delete=False) as file:
+        file.write(" " * padding + "({})[,]p".format(count))
+    try:
+        start = time.time()
+        subprocess.run([sys.executable, ly, file.name, "-ni"], check=True, stdout=subprocess.DEVNULL)
+        return time.time() - start
+    finally:
+        os.remove(file.name)
+
+
+print("{:>10} {:>18}".format("padding", "us per iteration"))
+for padding in (0, 1000, 10000, 100000):
+    per_iteration = (run(padding, iterations) - run(padding, 0)) / iterations
+    print("{:>10} {:>18.2f}".format(padding, per_iteration * 1e6))
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Runs every program in benchmarks/programs and reports, for each, how many Ly instructions it runs per second,
+# the peak memory of the process running it and how long that process takes to start it.
+# Usage: benchmarks/run.py [--ly path/to/ly.py] [--output results.json] [--baseline benchmarks/baseline.json]
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+programs = os.path.join(here, "programs")
+
+# the input each program reads, the others get none
+inputs = {
+    "numbers": lambda: "\n".join(map(str, range(400000))),
+}
+
+
+def load_ly(path):
+    spec = importlib.util.spec_from_file_location("ly", path)
+    ly = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ly)
+    return ly
+
+
+# runs in its own process, so that the peak memory is that of one program, and writes what it measured as JSON
+def measure(ly_path, path, options, count):
+    text = sys.stdin.read()
+    ly = load_ly(ly_path)
+    with open(path, encoding="utf-8") as file:
+        program = ly.compile(file.read())
+    result = {}
+    if count:
+        # the profile counts the instructions as written, whatever the run itself gets optimized into
+        profile = ly.Profile()
+        _, result["status"] = program.run(text, profile=profile)
+        result["instructions"] = sum(entry["hits"] for entry in profile.to_json()["indices"])
+    else:
+        start = time.perf_counter()
+        _, result["status"] = program.run(text, **options)
+        result["seconds"] = time.perf_counter() - start
+    # kilobytes on Linux, bytes on macOS
+    result["peak_memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    print(json.dumps(result))
+
+
+def run_child(ly_path, path, text, options, count):
+    start = time.perf_counter()
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", path, "--ly", ly_path,
+                            "--options", json.dumps(options)] + (["--count"] if count else []),
+                           input=text, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if child.returncode:
+        sys.exit("measuring {} failed:\n{}".format(os.path.basename(path), child.stderr))
+    return json.loads(child.stdout), wall
+
+
+def run_case(ly_path, name, repeat, options):
+    path = os.path.join(programs, name + ".ly")
+    text = inputs.get(name, lambda: "")()
+    counted, _ = run_child(ly_path, path, text, options, True)
+    runs = [run_child(ly_path, path, text, options, False) for _ in range(repeat)]
+    seconds = min(result["seconds"] for result, _ in runs)
+    return {
+        "status": counted["status"],
+        "instructions": counted["instructions"],
+        "seconds": seconds,
+        "instructions_per_second": counted["instructions"] / seconds,
+        "peak_memory": max(result["peak_memory"] for result, _ in runs),
+        # everything the process spent on other than running the program, starting Python included
+        "startup": min(wall - result["seconds"] for result, wall in runs),
+    }
+
+
+# writes a line per case comparing it to the baseline, and returns whether none got slower than tolerance allows
+def compare(results, baseline, tolerance):
+    print("\n{:<12} {:>12} {:>12} {:>12}".format("vs baseline", "speed", "memory", "startup"))
+    fine = True
+    for name, case in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is None:
+            print("{:<12} {:>12}".format(name, "new"))
+            continue
+        speed = case["instructions_per_second"] / before["instructions_per_second"]
+        print("{:<12} {:>11.2f}x {:>11.2f}x {:>11.2f}x".format(
+            name, speed, case["peak_memory"] / before["peak_memory"], case["startup"] / before["startup"]))
+        if speed < 1 - tolerance:
+            fine = False
+    return fine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Ly interpreter.")
+    parser.add_argument("cases", help="Names of the programs to run. Defaults to all of them.", nargs="*")
+    parser.add_argument("--ly", help="The ly.py to benchmark.", default=os.path.join(here, os.pardir, "ly.py"))
+    parser.add_argument("--repeat", help="Times to time each program, the fastest counts.", type=int, default=3)
+    parser.add_argument("--options", help="JSON object of options to pass to Program.run.", default="{}")
+    parser.add_argument("--output", help="File to write the results to as JSON.")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare to.")
+    parser.add_argument(
+        "--tolerance", help="How much slower than the baseline a program may get before the run fails.", type=float,
+        default=0.1)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--count", help=argparse.SUPPRESS, action="store_true")
+    args = parser.parse_args(argv)
+    ly_path = os.path.abspath(args.ly)
+    options = json.loads(args.options)
+
+    if args.measure is not None:
+        measure(ly_path, args.measure, options, args.count)
+        return 0
+
+    names = args.cases or sorted(name[:-3] for name in os.listdir(programs) if name.endswith(".ly"))
+    results = {"python": platform.python_version(), "machine": platform.machine(), "options": options, "cases": {}}
+    print("{:<12} {:>14} {:>10} {:>16} {:>10} {:>10}".format("program", "instructions", "seconds", "instructions/s",
+                                                              "peak MB", "startup s"))
+    for name in names:
+        case = results["cases"][name] = run_case(ly_path, name, args.repeat, options)
+        print("{:<12} {:>14} {:>10.3f} {:>16.0f} {:>10.1f} {:>10.3f}".format(
+            name, case["instructions"], case["seconds"], case["instructions_per_second"],
+            case["peak_memory"] / (1 << 20), case["startup"]))
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
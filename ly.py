@@ -5,25 +5,28 @@
 # Commented code is for debugging, uncomment at will.
 
 import argparse
+import asyncio
+import bisect
+import builtins
+import codecs
+import collections
+import hashlib
+import io
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import time
 import random
+import signal
+import socketserver
 import sys
-
-parser = argparse.ArgumentParser()
-parser.add_argument("filename", help="File to interpret.")
-parser.add_argument(
-    "-d", "--debug", help="Output additional debug information.", action="store_true")
-parser.add_argument(
-    "-s", "--slow", help="Go through the program step-by-step.", action="store_true")
-parser.add_argument(
-    "-i", "--input", help="Input for the program. If not given, you will be prompted if the program requires input.")
-parser.add_argument(
-    "-t", "--time", help="Time to wait between each execution tick.", type=float)
-parser.add_argument(
-    "-ti", "--timeit", help="Time the program and output how long it took to finish execution.", action="store_true")
-parser.add_argument("-ni", "--no-input",
-                    help="Don't prompt for input, no matter what.", action="store_true")
-args = parser.parse_args()
+import threading
+from array import array
 
 # errors
 
@@ -48,81 +51,620 @@ class FunctionError(LyError):
     pass
 
 
-try:
-    with open(args.filename, encoding="utf-8") as file:
-        program = file.read()
-except FileNotFoundError:
-    print("That file couldn't be found.")
-    sys.exit(1)
+class ParseError(LyError):
+    pass
+
+
+class StepLimitError(LyError):
+    pass
+
+
+class TimeLimitError(LyError):
+    pass
+
+
+class MemoryLimitError(LyError):
+    pass
+
+
+# leaves the interpreter loop early, carrying what interpret should return
+class Halt(Exception):
+    pass
+
+
+# raised by the input of a program run by interpret_async when the line it needs hasn't arrived yet
+class InputPending(Exception):
+    pass
 
 
 brackets = "()[]{}"
 
 # remove comments and replace ()[]{} inside character and string literals
+# comments, strings (ended by a quote without a backslash before it) and character literals are matched as whole tokens,
+# so only the characters that start one are looked at and the rest is copied in slices
+
+tokens = re.compile(r"""#[^\n]*|"[^"]*(?:(?<=\\)"[^"]*)*"?|'.""", re.DOTALL)
+escape_brackets = str.maketrans({char: chr(0xFDD0 + idx) for idx, char in enumerate(brackets)})
+
+
+# returns the preprocessed program and its source map
+# the source map is a pair of lists, the preprocessed indices where comments were cut out and the source indices they continue from
 def preprocess(code):
-    result = ""
-    in_string = False
-    idx = 0
-    while idx < len(code):
+    starts = [0]
+    origins = [0]
+    removed = 0
+
+    def replace(token):
+        nonlocal removed
+        text = token.group()
+        if text[0] == "#":
+            end = token.end()
+            removed += len(text)
+            starts.append(end - removed)
+            origins.append(end)
+            return ""
+        return text.translate(escape_brackets)
+
+    return tokens.sub(replace, code), (starts, origins)
+
+
+# precompute where every jumping instruction lands, so jumps don't rescan the program
+# checks the brackets match on the way, raising ParseError with the index of the first one that doesn't
+
+jumping = re.compile(r'[][(){}$"]')
+closers = {"]": "[", ")": "(", "}": "{"}
+
+
+def find_jumps(code):
+    jumps = [None] * len(code)
+    open_brackets = []
+    skips = []
+    quotes = []
+    for match in jumping.finditer(code):
+        idx = match.start()
         char = code[idx]
-        if in_string:
-            if char in brackets:
-                result += chr(0xFDD0 + brackets.index(char))
-            elif char == '"':
-                in_string = code[idx-1] == "\\"
-                result += char
-            else:
-                result += char
-            idx += 1
-        else: # not in string
-            if char == "#":
-                while idx < len(code) and code[idx] != "\n":
-                    idx += 1
-            elif char == '"':
-                in_string = True
-                result += char
-                idx += 1
-            elif char == "'" and idx+1 < len(code):
-                if code[idx+1] in brackets:
-                    result += char + chr(0xFDD0 + brackets.index(code[idx+1]))
-                else:
-                    result += char + code[idx+1]
-                idx += 2
+        if char == '"':
+            # a string ends at the next quote that isn't preceded by a backslash
+            if idx and code[idx - 1] != "\\":
+                for start in quotes:
+                    jumps[start] = idx
+                quotes.clear()
+            quotes.append(idx)
+        elif char == "$":
+            skips.append((idx, [start for start in reversed(open_brackets) if code[start] == "["]))
+        elif char in closers:
+            if not open_brackets or code[open_brackets[-1]] != closers[char]:
+                raise ParseError("Unmatched brackets in program", idx)
+            start = open_brackets.pop()
+            jumps[start] = idx
+            jumps[idx] = start
+        else:
+            open_brackets.append(idx)
+    if open_brackets:
+        raise ParseError("Unmatched brackets in program", open_brackets[-1])
+    # $ skips past the ] enclosing it, innermost first
+    for idx, starts in skips:
+        jumps[idx] = tuple(jumps[start] for start in starts)
+    return jumps
+
+
+# decode the preprocessed program into a stream of (opcode, argument) instructions
+# every instruction falls through to the one after it, anything that jumps holds indices into the stream
+
+instructions = "inour+-*/%^LG;:p!lsf<>?=ycSJaNIRwW`,~"
+modifiable = "nou+:ps"
+
+
+def literal_value(char):
+    if 0xFDD0 <= ord(char) < 0xFDD0 + len(brackets):
+        return ord(brackets[ord(char) - 0xFDD0])
+    return ord(char)
+
+
+def error_of(function, *args):
+    try:
+        function(*args)
+    except Exception as err:
+        return err
+
+
+# returns (opcode, argument, successor), jump targets and the successor are program indices
+def decode(code, idx, jumps, names):
+    char = code[idx]
+    # at the start of the program this wraps around to the last character
+    last = code[idx - 1]
+    successor = idx + 1
+    if char.isdigit():
+        try:
+            op = ("push", int(char))
+        except ValueError as err:
+            op = ("raise", err)
+    elif char == "[":
+        op = ("[", jumps[idx])
+    elif char == "]":
+        op = ("]", jumps[idx] + 1)
+    elif char == "$":
+        op = ("$", tuple(end + 1 for end in jumps[idx]))
+    elif char == '"':
+        end = jumps[idx]
+        values = []
+        for pos in range(idx + 1, len(code) if end is None else end):
+            char = code[pos]
+            if char == '"':
+                # only escaped quotes come before the end of the string
+                values.append(ord(char))
+            elif char == "n":
+                values.append(ord("\n" if code[pos - 1] == "\\" else char))
+            elif char == "\\" and pos + 1 == len(code):
+                op = ("broken string", (tuple(values), error_of(code.__getitem__, pos + 1)))
+                break
+            elif char == "\\" and code[pos + 1] in ['"', 'n']:
+                pass
             else:
-                result += char
-                idx += 1
-    return result
+                values.append(literal_value(char))
+        else:
+            op = ("string", tuple(values))
+        if end is not None:
+            successor = end + 1
+    elif char == "'":
+        if idx + 1 < len(code):
+            op = ("push", literal_value(code[idx + 1]))
+        else:
+            op = ("raise", error_of(ord, None))
+        successor = idx + 2
+    elif char == "(":
+        end = jumps[idx]
+        body = "".join(char for char in code[idx + 1:end] if char.isdigit())
+        try:
+            op = ("push", int(body))
+        except ValueError:
+            op = ("nop", None)
+        successor = end
+    elif char == "{":
+        end = jumps[idx]
+        body = code[idx + 1:end].replace("{", "").replace("}", "")
+        op = ("{", (last, body, "i" in body))
+        successor = end
+    elif char == ";":
+        op = (";", None)
+        successor = None
+    elif char in modifiable and last == "&":
+        op = ("&" + char, None)
+    elif char in instructions:
+        op = (char, None)
+    else:
+        op = ("nop", None)
+    if code[idx] in names:
+        # this character might be a function by the time it runs
+        if code[idx + 1:idx + 2] == "{":
+            op, successor = ("nop", None), idx + 1
+        op = ("call", (code[idx], op[0], op[1], None if successor == idx + 1 else successor))
+        successor = idx + 1
+    return op + (successor,)
 
-preprocessed_program = preprocess(program)
 
-# check for matching brackets
+def jump_targets(opcode, arg):
+    if opcode in ("[", "]", "jump"):
+        return [arg]
+    if opcode == "$":
+        return list(arg)
+    if opcode == "call":
+        _, fallback, fallback_arg, target = arg
+        return jump_targets(fallback, fallback_arg) + ([target] if target is not None else [])
+    return []
 
-def match_brackets(code):
-    start_chars = "({["
-    end_chars = ")}]"
-    stack = []
-    for idx, char in enumerate(code):
-        if char in start_chars:
-            stack.append(char)
-        elif char in end_chars:
-            if not stack:
-                return False
-            stack_top = stack.pop()
-            balancing_bracket = start_chars[end_chars.index(char)]
-            if stack_top != balancing_bracket:
+
+# returns the instruction stream and the program index of each instruction
+# without skip_noops every executed character keeps its own instruction, which debugging relies on
+def compile_program(code, jumps=None, skip_noops=True):
+    if jumps is None:
+        jumps = find_jumps(code)
+    names = set()
+    idx = code.find("{")
+    while idx != -1:
+        names.add(code[idx - 1])
+        idx = code.find("{", idx + 1)
+
+    # only decode what can actually run, the inside of literals usually can't
+    decoded = [None] * len(code)
+    pending = [0]
+    while pending:
+        idx = pending.pop()
+        while idx is not None and idx < len(code) and decoded[idx] is None:
+            opcode, arg, successor = decoded[idx] = decode(code, idx, jumps, names)
+            pending += jump_targets(opcode, arg)
+            idx = successor
+
+    # a no-op can skip over more than itself, like a ( ) with no number in it, so follow where each one leads
+    def resolve(idx):
+        while skip_noops and idx < len(code) and decoded[idx][0] == "nop":
+            idx = min(decoded[idx][2], len(code))
+        return idx
+
+    # lay the stream out in program order, with explicit jumps where falling through isn't enough
+    kept = [idx for idx, op in enumerate(decoded) if op is not None and not (skip_noops and op[0] == "nop")]
+    layout = []
+    index = {}
+    for pos, idx in enumerate(kept):
+        index[idx] = len(layout)
+        layout.append((idx, decoded[idx][0], decoded[idx][1]))
+        successor = decoded[idx][2]
+        if successor is not None:
+            successor = resolve(min(successor, len(code)))
+            if successor != (kept[pos + 1] if pos + 1 < len(kept) else len(code)):
+                layout.append((idx, "jump", successor))
+    index[len(code)] = len(layout)
+    layout.append((len(code), "end", None))
+
+    def target(idx, loop_start=False):
+        idx = resolve(min(idx, len(code)))
+        if loop_start and skip_noops and decoded[idx][0] == "]":
+            # the ] would only check the same condition again and fall through
+            idx = resolve(idx + 1)
+        return index[idx]
+
+    def link(opcode, arg):
+        if opcode == "[":
+            return target(arg, loop_start=True)
+        if opcode in ("]", "jump"):
+            return target(arg)
+        if opcode == "$":
+            return tuple(target(idx) for idx in arg)
+        if opcode == "call":
+            char, fallback, fallback_arg, successor = arg
+            return (char, fallback, link(fallback, fallback_arg), None if successor is None else target(successor))
+        return arg
+
+    ops = []
+    positions = array("q")
+    interned = {}
+    for idx, opcode, arg in layout:
+        op = (opcode, link(opcode, arg))
+        ops.append(interned.setdefault(op, op))
+        positions.append(idx)
+    return ops, positions
+
+
+# constant operations a run of literals can be folded through, none of them can fail on integers
+folds = {"+": lambda y, x: y + x, "-": lambda y, x: y - x, "*": lambda y, x: y * x}
+
+
+# returns the fused instruction starting at pc and how many instructions it replaces, or None
+# sources has the instructions that jump or return to each instruction, which can only be fused into another
+# when all of them are fused along with it
+def fuse(ops, pc, sources, level):
+    opcode, arg = ops[pc]
+
+    def inner(idx, end):
+        return idx < len(ops) and all(pc <= source < end for source in sources.get(idx, ()))
+
+    def following(*expected):
+        end = pc + len(expected) + 1
+        for idx, (opcode, arg) in enumerate(expected, pc + 1):
+            if not inner(idx, end) or ops[idx][0] != opcode or arg is not None and ops[idx][1] != arg:
                 return False
-    return not stack
+        return True
+
+    if level >= 2:
+        # [p] pops until the top is zero, [,] counts the top down to zero
+        if opcode == "[" and following(("p", None), ("]", pc + 1)):
+            return ("pop nonzero", None), 3
+        if opcode == "[" and following((",", None), ("]", pc + 1)):
+            return ("count down", None), 3
+        if opcode == ":" and following(("push", None), ("=", None)):
+            return ("duplicate equal", ops[pc + 1][1]), 3
+
+    if opcode not in ("push", "string"):
+        return None
+    # literals only get folded with each other, so nothing here ever pops a value the program had, or input
+    values = []
+    end = pc
+    while end < len(ops) and (end == pc or inner(end, end + 1)):
+        opcode, arg = ops[end]
+        if opcode == "push":
+            values.append(arg)
+        elif opcode == "string":
+            values.extend(arg)
+        elif opcode in folds and len(values) >= 2:
+            x = values.pop()
+            y = values.pop()
+            values.append(folds[opcode](y, x))
+        else:
+            break
+        end += 1
+    if values and inner(end, end + 1) and ops[end] == ("&o", None):
+        try:
+            return ("print string", (tuple(values), "".join(map(chr, values)))), end + 1 - pc
+        except (ValueError, OverflowError):
+            pass
+    if end - pc < 2:
+        return None
+    return ("push", values[0]) if len(values) == 1 else ("string", tuple(values)), end - pc
+
+
+# fuses the common idioms of a compiled program into single instructions that do the same
+# level 1 folds runs of literals and prints literal strings in one go, level 2 also fuses small loops and comparisons
+def optimize_program(ops, positions, level):
+    if level <= 0:
+        return ops, positions
+    # programs and functions start at the first instruction
+    sources = {0: {-1}}
+    for pc, (opcode, arg) in enumerate(ops):
+        for target in jump_targets(opcode, arg):
+            sources.setdefault(target, set()).add(pc)
+        if opcode == "call":
+            # the function returns to the instruction after the call
+            sources.setdefault(pc + 1, set()).add(pc)
+
+    fused_ops = []
+    fused_positions = array("q")
+    index = {}
+    pc = 0
+    while pc < len(ops):
+        index[pc] = len(fused_ops)
+        op, count = fuse(ops, pc, sources, level) or (ops[pc], 1)
+        fused_ops.append(op)
+        fused_positions.append(positions[pc])
+        pc += count
+
+    def relink(opcode, arg):
+        if opcode in ("[", "]", "jump"):
+            return index[arg]
+        if opcode == "$":
+            return tuple(index[pc] for pc in arg)
+        if opcode == "call":
+            char, fallback, fallback_arg, successor = arg
+            return (char, fallback, relink(fallback, fallback_arg), None if successor is None else index[successor])
+        return arg
+
+    return [(opcode, relink(opcode, arg)) for opcode, arg in fused_ops], fused_positions
+
+
+# instructions that can go somewhere other than the next one, or change which stack is the current one,
+# so they end the straight-line blocks the Python backend turns a program into
+block_ends = {"[", "]", "jump", "end", "$", ";", "call", "count down", "<", ">", "R", "raise", "broken string"}
+
+# the Python the backend writes for the simplest instructions, anything else calls the instruction's handler
+# pop_value is only called when there aren't enough values, like in pop1 and pop2
+pop_two = [
+    "if len(stack) > 1:",
+    "    x = stack.pop()",
+    "    y = stack.pop()",
+    "else:",
+    "    x, y = stack.pop_value(2)",
+]
+inline = {
+    ":": ["if stack:", "    stack.append(stack[-1])"],
+    "p": ["stack.pop() if stack else stack.pop_value(implicit=False)"],
+    "`": ["stack.append((stack.pop() if stack else stack.pop_value()) + 1)"],
+    ",": ["stack.append((stack.pop() if stack else stack.pop_value()) - 1)"],
+    "+": pop_two + ["stack.append(y + x)"],
+    "-": pop_two + ["stack.append(y - x)"],
+    "*": pop_two + ["stack.append(y * x)"],
+}
+
+
+# turns a compiled program into the source of a Python function, build(current, code, check)
+# build returns code with the instruction at the start of each block replaced by a function running the whole block,
+# taking and returning the instruction to continue at like any handler, with current() giving the current stack
+# with limited, loops call check() every so often, like the interpreter does for the limits
+# also returns the instruction each line of the source comes from, to report errors at
+def transpile(ops, limited):
+    starts = {0}
+    for pc, (opcode, arg) in enumerate(ops):
+        starts.update(jump_targets(opcode, arg))
+        if opcode in block_ends:
+            starts.add(pc + 1)
+        if opcode == "count down":
+            # it continues at itself until it's done
+            starts.add(pc)
+    starts = sorted(start for start in starts if start < len(ops))
+
+    source = []
+    # line numbers start at 1
+    lines = [0]
 
+    def emit(indent, pc, *statements):
+        for statement in statements:
+            source.append("    " * indent + statement)
+            lines.append(pc)
+
+    emit(0, 0, "def build(current, code, check):")
+    emit(1, 0, "code = list(code)")
+    for pc, (opcode, arg) in enumerate(ops):
+        if opcode not in inline and opcode not in ("push", "[", "]", "jump", "nop"):
+            emit(1, pc, "h{0}, a{0} = code[{0}]".format(pc))
+        elif opcode in ("push", "string") and type(arg) is not int:
+            emit(1, pc, "a{0} = code[{0}][1]".format(pc))
+
+    for start, stop in zip(starts, starts[1:] + [len(ops)]):
+        last_opcode, last_arg = ops[stop - 1]
+        looping = last_opcode == "]" and last_arg == start
+        emit(1, start, "def b{}(arg, pc):".format(start), "    stack = current()")
+        indent = 2
+        if looping:
+            if limited:
+                emit(indent, start, "ticks = 0")
+            emit(indent, start, "while True:")
+            indent += 1
+        pc = start
+        while pc < stop:
+            opcode, arg = ops[pc]
+            following = ops[pc + 1][0] if pc + 1 < stop else None
+            if opcode == "push" and type(arg) is int and following in ("+", "-", "*"):
+                # a literal and an operation on it only need the stack to have one value
+                emit(indent, pc, "if stack:")
+                emit(indent + 1, pc + 1, "stack.append(stack.pop() {} {!r})".format(following, arg))
+                emit(indent, pc, "else:", "    stack.append({!r})".format(arg))
+                emit(indent + 1, pc + 1, *inline[following])
+                pc += 2
+                continue
+            if opcode == "nop":
+                pass
+            elif opcode == "push":
+                emit(indent, pc, "stack.append({})".format(repr(arg) if type(arg) is int else "a{}".format(pc)))
+            elif opcode == "string":
+                emit(indent, pc, "stack.extend(a{})".format(pc))
+            elif opcode in inline:
+                emit(indent, pc, *inline[opcode])
+            elif opcode == "[":
+                emit(indent, pc, "if stack and stack[-1]:", "    return {}".format(pc + 1), "return {}".format(arg))
+            elif opcode == "]" and looping and pc == stop - 1:
+                emit(indent, pc, "if not (stack and stack[-1]):", "    return {}".format(pc + 1))
+                if limited:
+                    # the interpreter checks the limits about this often
+                    emit(indent, pc, "ticks += 1", "if ticks == {}:".format(max(limit_interval // (stop - start), 1)),
+                         "    ticks = 0", "    check()")
+            elif opcode == "]":
+                emit(indent, pc, "if stack and stack[-1]:", "    return {}".format(arg), "return {}".format(pc + 1))
+            elif opcode == "jump":
+                emit(indent, pc, "return {}".format(arg))
+            elif opcode in block_ends:
+                emit(indent, pc, "return h{0}(a{0}, {0})".format(pc))
+            else:
+                emit(indent, pc, "h{0}(a{0}, {0})".format(pc))
+            pc += 1
+        if last_opcode not in block_ends:
+            emit(indent, stop - 1, "return {}".format(stop))
+        emit(1, start, "code[{0}] = (b{0}, None)".format(start))
+    emit(1, 0, "return code")
+    return "\n".join(source) + "\n", lines
+
+
+# the instruction a Python backend error happened at, from the innermost generated code in its traceback
+def transpiled_pc(traceback, pc):
+    while traceback is not None:
+        lines = traceback.tb_frame.f_globals.get("ly_lines")
+        if lines is not None:
+            pc = lines[traceback.tb_lineno]
+        traceback = traceback.tb_next
+    return pc
+
+
+# reports an error that stopped a program, function_name is the function it happened in if any
+def print_error(err, idx, char, line, column, function_name=None):
+    if function_name is not None:
+        print("Error occurred in function {}, index {}, instruction {} (zero-indexed, excludes comments), line {}, column {}".format(
+            function_name, idx, char, line, column), file=sys.stderr)
+    else:
+        print("Error occurred at program index {}, instruction {} (zero-indexed, excludes comments), line {}, column {}".format(
+            idx, char, line, column), file=sys.stderr)
+    print(type(err).__name__, str(err), sep=": ", file=sys.stderr)
+
+
+# how many instructions run between checks of the limits on a program
+limit_interval = 1024
+# compact stacks at least this long get summed and sorted by NumPy, when it's installed
+numpy_threshold = 4096
+# stacks at least this long start keeping a count of their values the first time ~ looks through them
+count_threshold = 256
+# ranges from R at least this long are kept as ranges until their values are taken apart
+range_threshold = 4096
+numpy = None
+
+
+# NumPy is only imported once a stack is long enough to use it, since importing it takes longer than most programs run
+def load_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy
 
-if not match_brackets(preprocessed_program):
-    print("Error occurred during parsing", file=sys.stderr)
-    print("SyntaxError: Unmatched brackets in program", file=sys.stderr)
-    sys.exit(1)
 
+# the stacks < and > move between, which can grow at either end in constant time
+# it's indexed from the leftmost stack like a list, with the ones added on the left kept in reverse order in left
+# changes counts the stacks added or replaced, so tracing can tell when it has to look at them again
+class Tape:
+    __slots__ = ("left", "right", "changes")
 
-def interpret(program, input_function, output_function, *, debug=False, delay=0, step_by_step=False):
+    def __init__(self, stack):
+        self.left = []
+        self.right = [stack]
+        self.changes = 0
 
-    class Stack(list):
+    def __len__(self):
+        return len(self.left) + len(self.right)
+
+    def __getitem__(self, index):
+        index -= len(self.left)
+        if index >= 0:
+            return self.right[index]
+        return self.left[-index - 1]
+
+    def __iter__(self):
+        yield from reversed(self.left)
+        yield from self.right
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __setitem__(self, index, stack):
+        self.changes += 1
+        index -= len(self.left)
+        if index >= 0:
+            self.right[index] = stack
+        else:
+            self.left[-index - 1] = stack
+
+    def prepend(self, stack):
+        self.changes += 1
+        self.left.append(stack)
+
+    def append(self, stack):
+        self.changes += 1
+        self.right.append(stack)
+
+
+# max_steps limits the instructions run, time_limit the seconds taken and max_stack_size the values held by all stacks
+# the time and stack size are checked every limit_interval instructions, and before anything that could overshoot by a lot
+# a Profile passed as profile gets filled in with what the program spent its time on, a Trace passed as trace with every step
+# compact_stacks keeps the stacks in arrays of 64 bit integers while the values fit, which takes far less memory than lists
+# optimization is the level of optimize_program to use, and backend "py" runs the program as the Python transpile makes
+# of it instead of one instruction at a time, both would throw off the step counts of max_steps, profiling, tracing
+# and debugging, so none of those get optimized or transpiled
+def interpret(program, input_function, output_function, **options):
+    run = execute(program, input_function, output_function, **options)
+    try:
+        next(run)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("the program stopped for interpret_async")
+
+
+# interpret, as a generator that only yields when run with an interval by interpret_async, and returns the result
+# requests then gets what the program outputs and how long it waits, instead of them happening right away
+def execute(program, input_function, output_function, *, debug=False, delay=0, step_by_step=False,
+            max_steps=None, time_limit=None, max_stack_size=None, on_error=print_error, profile=None, trace=None,
+            compact_stacks=False, optimization=2, backend="interpreter", memoize=0, interval=None, requests=None):
+    if interval is not None:
+        backend = "interpreter"
+    traced = debug or delay or step_by_step
+    if traced or max_steps is not None or profile is not None or trace is not None:
+        optimization = 0
+        backend = "interpreter"
+    limited = max_steps is not None or time_limit is not None or max_stack_size is not None
+    steps_left = max_steps
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+    if not isinstance(program, Program):
+        program = Program(program, preprocessed=True)
+
+    # outputs that buffer get to write out what they hold whenever the program stops to wait
+    pause = getattr(output_function, "pause", lambda: None)
+    # inputs that can read many numbers at once get used for dumping input onto the stack
+    bulk_numbers = getattr(input_function, "numbers", None)
+    if hasattr(output_function, "pause"):
+        read_line = input_function
+
+        def input_function():
+            pause()
+            return read_line()
+    program_input = input_function
+
+    # what every kind of stack has on top of pop, append and its length
+    class StackMethods:
         nonlocal debug
 
         def get_value(self):
@@ -162,12 +704,382 @@ def interpret(program, input_function, output_function, *, debug=False, delay=0,
 
             return results[0] if len(results) <= 1 else results
 
+        # pop_value() and pop_value(2), without its bookkeeping when the stack holds enough values
+        def pop1(self):
+            if self:
+                return self.pop()
+            return self.pop_value()
+
+        def pop2(self):
+            if len(self) > 1:
+                return self.pop(), self.pop()
+            return self.pop_value(2)
+
         def add_value(self, value):
             if type(value) == list:
                 self += value
             else:
                 self.append(value)
 
+        def total(self):
+            return sum(self)
+
+        # pops values until the top one is zero, like [p]
+        def pop_nonzero(self):
+            end = len(self)
+            while end and self[end - 1]:
+                end -= 1
+            del self[end:]
+
+        def contains(self, value):
+            if len(self) >= count_threshold:
+                self.__class__ = self.counted
+                self.counts = collections.Counter(self)
+                return self.contains(value)
+            return value in self
+
+    # keeps a count of every value on the stack up to date, so ~ doesn't have to look through it
+    class CountedMethods:
+
+        def contains(self, value):
+            return self.counts[value] > 0
+
+        def discard(self, value):
+            counts = self.counts
+            counts[value] -= 1
+            if not counts[value]:
+                del counts[value]
+
+        def append(self, value):
+            super().append(value)
+            self.counts[value] += 1
+
+        def extend(self, values):
+            if type(values) not in (list, tuple, range):
+                values = list(values)
+            super().extend(values)
+            self.counts.update(values)
+
+        def __iadd__(self, values):
+            self.extend(values)
+            return self
+
+        def pop(self):
+            value = super().pop()
+            self.discard(value)
+            return value
+
+        def __setitem__(self, index, value):
+            old = self[index]
+            super().__setitem__(index, value)
+            self.discard(old)
+            self.counts[value] += 1
+
+        def __delitem__(self, index):
+            if index == slice(None):
+                super().__delitem__(index)
+                self.counts.clear()
+                return
+            removed = self[index]
+            super().__delitem__(index)
+            for value in removed if type(index) is slice else (removed,):
+                self.discard(value)
+
+    class Stack(StackMethods, list):
+        pass
+
+    # keeps its values in an array of 64 bit integers until one that doesn't fit turns it into a list,
+    # and otherwise behaves like a list, errors included
+    class ArrayStack(StackMethods):
+        __slots__ = ("values",)
+
+        def __init__(self):
+            self.values = array("q")
+
+        def promote(self):
+            if type(self.values) is not list:
+                self.values = list(self.values)
+
+        def append(self, value):
+            try:
+                self.values.append(value)
+            except (TypeError, OverflowError):
+                self.promote()
+                self.values.append(value)
+
+        def extend(self, values):
+            if type(values) not in (list, tuple, range):
+                values = list(values)
+            size = len(self.values)
+            try:
+                self.values.extend(values)
+            except (TypeError, OverflowError):
+                del self.values[size:]
+                self.promote()
+                self.values.extend(values)
+
+        def __iadd__(self, values):
+            self.extend(values)
+            return self
+
+        def pop(self):
+            try:
+                return self.values.pop()
+            except IndexError as err:
+                raise IndexError(str(err).replace("array", "list")) from None
+
+        def __getitem__(self, index):
+            if type(index) is slice:
+                return list(self.values[index])
+            try:
+                return self.values[index]
+            except IndexError as err:
+                raise IndexError(str(err).replace("array", "list")) from None
+
+        def __setitem__(self, index, value):
+            try:
+                self.values[index] = value
+            except (TypeError, OverflowError):
+                self.promote()
+                self.values[index] = value
+            except IndexError as err:
+                raise IndexError(str(err).replace("array", "list")) from None
+
+        def __delitem__(self, index):
+            del self.values[index]
+            if not self.values:
+                self.values = array("q")
+
+        def __len__(self):
+            return len(self.values)
+
+        def __iter__(self):
+            return iter(self.values)
+
+        def __contains__(self, value):
+            return value in self.values
+
+        def __repr__(self):
+            return repr(list(self.values))
+
+        def reverse(self):
+            self.values.reverse()
+
+        def sort(self):
+            if type(self.values) is list:
+                self.values.sort()
+            elif len(self.values) >= numpy_threshold and load_numpy():
+                numpy.frombuffer(self.values, numpy.int64).sort()
+            else:
+                self.values = array("q", sorted(self.values))
+
+        def total(self):
+            values = self.values
+            if type(values) is not list and len(values) >= numpy_threshold and load_numpy():
+                view = numpy.frombuffer(values, numpy.int64)
+                # NumPy sums wrap around silently, so it only gets the ones that can't overflow
+                if max(-int(view.min()), int(view.max())) * len(values) < 1 << 63:
+                    return int(view.sum())
+            return sum(values)
+
+    # keeps the ranges R makes as ranges, next to lists of the other values, so a range takes no memory
+    # until it's taken apart, and summing, reversing, popping and looking values up in it don't need to
+    class RangeStack(StackMethods):
+        __slots__ = ("segments", "size")
+
+        def __init__(self, values=()):
+            self.segments = []
+            self.size = 0
+            self.extend(values)
+
+        def find(self, index):
+            if not isinstance(index, int):
+                raise TypeError("list indices must be integers or slices, not " + type(index).__name__)
+            if not -sys.maxsize - 1 <= index <= sys.maxsize:
+                raise IndexError("cannot fit 'int' into an index-sized integer")
+            if index < 0:
+                index += self.size
+            if not 0 <= index < self.size:
+                return None
+            # most lookups are near the top
+            start = self.size
+            for number in range(len(self.segments) - 1, -1, -1):
+                start -= len(self.segments[number])
+                if index >= start:
+                    return number, index - start
+
+        def materialize(self, values):
+            self.segments = [values] if values else []
+            self.size = len(values)
+
+        def append(self, value):
+            if self.segments and type(self.segments[-1]) is list:
+                self.segments[-1].append(value)
+            else:
+                self.segments.append([value])
+            self.size += 1
+
+        def extend(self, values):
+            if type(values) is range and len(values) >= range_threshold:
+                self.segments.append(values)
+                self.size += len(values)
+                return
+            if type(values) is RangeStack:
+                self.segments += [segment if type(segment) is range else segment[:] for segment in values.segments]
+                self.size += values.size
+                return
+            if not self.segments or type(self.segments[-1]) is range:
+                self.segments.append([])
+            top = self.segments[-1]
+            size = len(top)
+            try:
+                top.extend(values)
+            finally:
+                self.size += len(top) - size
+                if not top:
+                    self.segments.pop()
+
+        def __iadd__(self, values):
+            self.extend(values)
+            return self
+
+        def pop(self):
+            if not self.segments:
+                raise IndexError("pop from empty list")
+            top = self.segments[-1]
+            value = top[-1]
+            if len(top) == 1:
+                self.segments.pop()
+            elif type(top) is range:
+                self.segments[-1] = top[:-1]
+            else:
+                top.pop()
+            self.size -= 1
+            return value
+
+        def __getitem__(self, index):
+            if type(index) is slice:
+                return list(self)[index]
+            found = self.find(index)
+            if found is None:
+                raise IndexError("list index out of range")
+            number, offset = found
+            return self.segments[number][offset]
+
+        def __setitem__(self, index, value):
+            found = self.find(index)
+            if found is None:
+                raise IndexError("list assignment index out of range")
+            number, offset = found
+            segment = self.segments[number]
+            if type(segment) is list:
+                segment[offset] = value
+            else:
+                parts = (segment[:offset], [value], segment[offset + 1:])
+                self.segments[number:number + 1] = [part for part in parts if part]
+
+        def __delitem__(self, index):
+            if type(index) is not slice or index.step is not None:
+                values = list(self)
+                del values[index]
+                self.materialize(values)
+                return
+            start, stop, _ = index.indices(self.size)
+            if start >= stop:
+                return
+            if stop < self.size:
+                values = list(self)
+                del values[start:stop]
+                self.materialize(values)
+                return
+            while self.size > start:
+                top = self.segments[-1]
+                if self.size - len(top) >= start:
+                    self.segments.pop()
+                    self.size -= len(top)
+                else:
+                    keep = start - (self.size - len(top))
+                    self.segments[-1] = top[:keep]
+                    self.size = start
+
+        def __len__(self):
+            return self.size
+
+        def __iter__(self):
+            return itertools.chain.from_iterable(self.segments)
+
+        def __contains__(self, value):
+            for segment in self.segments:
+                if type(segment) is range and type(value) is not int:
+                    # ranges look through anything but integers one value at a time
+                    if type(value) is float:
+                        if value.is_integer() and int(value) in segment:
+                            return True
+                        continue
+                if value in segment:
+                    return True
+            return False
+
+        def __repr__(self):
+            return repr(list(self))
+
+        # a range answers ~ by itself, without keeping a count of its values
+        def contains(self, value):
+            return value in self
+
+        def reverse(self):
+            self.segments.reverse()
+            for number, segment in enumerate(self.segments):
+                if type(segment) is range:
+                    self.segments[number] = segment[::-1]
+                else:
+                    segment.reverse()
+
+        def sort(self):
+            if len(self.segments) == 1 and type(self.segments[0]) is range:
+                if self.segments[0].step < 0:
+                    self.segments[0] = self.segments[0][::-1]
+                return
+            self.materialize(sorted(self))
+
+        def pop_nonzero(self):
+            end = self.size
+            for segment in reversed(self.segments):
+                if type(segment) is range:
+                    if 0 in segment:
+                        end -= len(segment) - segment.index(0) - 1
+                        break
+                    end -= len(segment)
+                else:
+                    for value in reversed(segment):
+                        if not value:
+                            break
+                        end -= 1
+                    else:
+                        continue
+                    break
+            del self[end:]
+
+        def total(self):
+            result = 0
+            for segment in self.segments:
+                if type(segment) is range and type(result) is int:
+                    result += len(segment) * (segment[0] + segment[-1]) // 2
+                else:
+                    # carrying on from the result keeps floats adding up in the same order
+                    result = sum(segment, result)
+            return result
+
+    class CountedStack(CountedMethods, Stack):
+        pass
+
+    class CountedArrayStack(CountedMethods, ArrayStack):
+        pass
+
+    Stack.counted = CountedStack
+    ArrayStack.counted = CountedArrayStack
+    new_stack = ArrayStack if compact_stacks else Stack
+
     def take_input():
         nonlocal input_function
 
@@ -181,6 +1093,15 @@ def interpret(program, input_function, output_function, *, debug=False, delay=0,
     def dump_input():
         nonlocal take_input
 
+        if input_function is program_input and bulk_numbers is not None:
+            pause()
+            values, complete = bulk_numbers()
+            stack.extend(values)
+            if not complete:
+                raise InputError(
+                    "program expected integer input, got string instead")
+            return
+
         stdin = take_input()
 
         while stdin:
@@ -191,386 +1112,1831 @@ def interpret(program, input_function, output_function, *, debug=False, delay=0,
                     "program expected integer input, got string instead")
             stdin = take_input()
 
-    stacks = [Stack()]
+    stacks = Tape(new_stack())
     stack = stacks[0]
     stack_pointer = 0
-    idx = 0
     backup = None
     functions = {}
+    function_name = None
     errors = (LyError, ZeroDivisionError, IndexError)
-    while idx < len(program):
-        char = program[idx]
-        try:
-            next = program[idx + 1]
-        except IndexError:
-            next = None
-        try:
-            last = program[idx - 1]
-        except IndexError:
-            last = None
-        if delay:
-            time.sleep(delay)
+    # everything needed to return to the callers of the running function, innermost last
+    frames = []
+    caller_stack = None
+    # the fewest values the caller's stack has been down to, which tracing keeps track of
+    caller_low = 0
+    # a trace couldn't follow the changes a remembered call makes to its caller's stack
+    calls = CallCache(memoize) if memoize and trace is None else None
+    if calls is not None and profile is not None:
+        profile.memoized = calls
+    # what the running call of a pure function has taken from its caller's stack, and how many values that left there,
+    # while it can still be remembered
+    taken = None
+    taken_base = 0
+
+    # instructions take their argument and their own position, and return the position to go to next
+
+    def nop(arg, pc):
+        return pc + 1
+
+    def jump(arg, pc):
+        return arg
+
+    def end(arg, pc):
+        if not frames:
+            raise Halt(None)
         if debug:
-            print(" | ".join([char, str(stacks), str(backup), output_function.__name__, str(idx - 1), str(stack_pointer)]), end=(
-                "\n" if not step_by_step else ""))
+            print("outputting implicitly")
+        caller_stack.extend(stack)
+        return leave()
+
+    def fail(arg, pc):
+        raise arg
+
+    def push(arg, pc):
+        stack.append(arg)
+        return pc + 1
+
+    def push_string(arg, pc):
+        stack.extend(arg)
+        return pc + 1
+
+    def push_broken_string(arg, pc):
+        stack.extend(arg[0])
+        raise arg[1]
+
+    # the instructions optimize_program fuses idioms into
+
+    def print_string(arg, pc):
+        values, text = arg
+        if stack:
+            stack.extend(values)
+            return output_chars(None, pc)
+        output_function(text)
+        return pc + 1
+
+    def pop_nonzero(arg, pc):
+        stack.pop_nonzero()
+        return pc + 1
+
+    def count_down(arg, pc):
+        if stack and stack[-1]:
+            value = stack[-1]
+            if type(value) is int and value > 0:
+                stack[-1] = 0
+                return pc + 1
+            # anything else counts down forever, a step at a time so the limits still get checked
+            stack[-1] = value - 1
+            return pc
+        return pc + 1
+
+    def duplicate_equal(arg, pc):
+        if stack:
+            value = stack[-1]
+            stack.append(value)
+            stack.append(int(arg == value))
+        else:
+            stack.append(0)
+        return pc + 1
+
+    # a function reads its input from the stack it was called from and outputs back onto it
+
+    def function_input():
+        nonlocal caller_low, taken, taken_base
+        if taken is not None and len(caller_stack) != taken_base:
+            # what the function output would be taken back, which the call cache can't express
+            taken = None
+        if not caller_stack:
+            if taken is not None and taken[-1:] != [None]:
+                taken.append(None)
+            return 0
+        value = str(caller_stack.pop1())
+        caller_low = min(caller_low, len(caller_stack))
+        if taken is not None:
+            taken.append(value)
+            taken_base = len(caller_stack)
+        return value
+
+    def function_execution(value):
+        if type(value) == str:
+            # every character that was output becomes a value, line breaks only separate them
+            for line in value.splitlines():
+                caller_stack.extend(map(ord, line))
+        else:
+            caller_stack.append(value)
+
+    def call(arg, pc):
+        nonlocal code, ops, positions, text, stacks, stack, stack_pointer, backup, functions, function_name
+        nonlocal input_function, output_function, caller_stack, taken, taken_base
+        char, fallback, fallback_arg, target = arg
+        if char not in functions:
+            pc_after = fallback(fallback_arg, pc)
+            return pc_after if target is None else target
+        if calls is not None and calls.pure(program.function(functions[function_name])):
+            found = calls.find(function_name, functions[function_name], stack)
+            if found is not None:
+                count, produced = found
+                if debug:
+                    print("remembered call to " + function_name)
+                for _ in range(count):
+                    stack.pop()
+                stack.extend(produced)
+                return pc + 1
+            taken, taken_base = [], len(stack)
+        frames.append((code, ops, positions, text, pc + 1, stacks, stack, stack_pointer, backup,
+                       functions, function_name, input_function, output_function, caller_stack))
+        code, ops, positions, text = prepare(program.function(functions[function_name]))
+        caller_stack = stack
+        stacks = Tape(new_stack())
+        stack = stacks[0]
+        stack_pointer = 0
+        backup = None
+        functions = {}
+        function_name = None
+        input_function = function_input
+        output_function = function_execution
+        return 0
+
+    # returns to the caller of the running function, and where to continue there
+    def leave():
+        nonlocal code, ops, positions, text, stacks, stack, stack_pointer, backup, functions, function_name
+        nonlocal input_function, output_function, caller_stack, taken
+        (code, ops, positions, text, pc, stacks, stack, stack_pointer, backup,
+         functions, function_name, input_function, output_function, caller_stack) = frames.pop()
+        if taken is not None:
+            calls.add(functions[function_name], taken, [stack[idx] for idx in range(taken_base, len(stack))])
+            taken = None
+        return pc
+
+    def loop_start(arg, pc):
+        if stack and stack[-1]:
+            return pc + 1
+        return arg
+
+    def loop_end(arg, pc):
+        if stack and stack[-1]:
+            return arg
+        return pc + 1
+
+    def skip(arg, pc):
+        # skipping past more ] than enclose us stops at the outermost one
+        count = len(range(stack.pop_value(implicit=False)))
+        if count and arg:
+            return arg[min(count, len(arg)) - 1]
+        return pc + 1
+
+    def stop(arg, pc):
+        if not frames:
+            raise Halt(True)
+        return leave()
+
+    def define(arg, pc):
+        nonlocal function_name
+        function_name, function_body, takes_input = arg
+        if takes_input:
+            raise FunctionError("functions cannot contain the 'i' instruction")
+        functions[function_name] = function_body
+        return pc + 1
+
+    def read_chars(arg, pc):
         try:
-            if char in functions:
-                def function_input():
-                    nonlocal stack
+            stdin = input_function()
+            for char in stdin:
+                stack.append(ord(char))
+        except EOFError:
+            stack.append(0)
+        return pc + 1
 
-                    return str(stack.pop_value()) if stack else 0
+    def read_number(arg, pc):
+        try:
+            stack.append(int(take_input()))
+        except ValueError:
+            raise InputError(
+                "program expected integer input, got string instead")
+        return pc + 1
 
-                def function_execution(value):
-                    nonlocal stack
+    def read_numbers(arg, pc):
+        # an input that gets its lines as they come needs all of them before any go onto the stack
+        prefetch = getattr(input_function, "prefetch", None)
+        if prefetch is not None:
+            prefetch()
+        dump_input()
+        return pc + 1
 
-                    for val in value.splitlines():
-                        if type(val) == int:
-                            stack.add_value(val)
-                        else:
-                            stack.add_value(ord(val))
-                try:
-                    interpret(functions[function_name], function_input, function_execution,
-                              debug=debug, delay=delay, step_by_step=step_by_step)
-                except FunctionError as err:
-                    err_info = str(err).split("$$")
-                    print("Error occurred in function {}, index {}, instruction {} (zero-indexed, excludes comments)".format(
-                        function_name, err_info[1], err_info[2]), file=sys.stderr)
-                    print(err_info[0], file=sys.stderr)
-                    return False
-            elif next == "{":
+    def output_char(arg, pc):
+        output_function(chr(stack.pop_value(implicit=False)))
+        return pc + 1
+
+    def output_chars(arg, pc):
+        if not stack:
+            stack.extend(map(ord, take_input()))
+        if not debug:
+            try:
+                text = "".join(map(chr, stack))
+            except (TypeError, ValueError, OverflowError):
                 pass
-            elif char.isdigit():
-                stack.add_value(int(char))
-            elif char == "[":
-                if not stack.get_value():
-                    extra = 0
-                    for pos, char in enumerate(program[idx + 1:]):
-                        # print("Char: " + char)
-                        if char == "[":
-                            extra += 1
-                        elif char == "]":
-                            if extra:
-                                extra -= 1
-                            else:
-                                # print("Position: " + str(pos))
-                                idx += pos
-                                break
-            elif char == "]":
-                if not stack.get_value():
-                    pass
-                else:
-                    extra = 0
-                    for pos, char in reversed(list(enumerate(program[:idx]))):
-                        # print("Char: " + char)
-                        if char == "]":
-                            extra += 1
-                        elif char == "[":
-                            if extra:
-                                extra -= 1
-                            else:
-                                # print("Position: " + str(pos))
-                                idx = pos
-                                break
-            elif char == "i":
-                try:
-                    stdin = input_function()
-                    for char in stdin:
-                        stack.add_value(ord(char))
-                except EOFError:
-                    stack.add_value(0)
-            elif char == "n":
-                if last == "&":
-                    dump_input()
-                else:
+            else:
+                output_function(text)
+                del stack[:]
+                return pc + 1
+        # debugging shows each character as its own output, and a value that isn't one stops it partway
+        for val in stack[:]:
+            output_function(chr(val))
+            stack.pop_value(implicit=False)
+        return pc + 1
+
+    def output_number(arg, pc):
+        output_function(stack.pop_value(implicit=False))
+        return pc + 1
+
+    def output_numbers(arg, pc):
+        if not stack:
+            dump_input()
+        output_function("\n".join(map(str, stack)))
+        del stack[:]
+        return pc + 1
+
+    def reverse(arg, pc):
+        if not stack:
+            dump_input()
+        stack.reverse()
+        return pc + 1
+
+    def add(arg, pc):
+        x, y = stack.pop2()
+        stack.append(y + x)
+        return pc + 1
+
+    def add_all(arg, pc):
+        if not stack:
+            dump_input()
+        result = stack.total()
+        del stack[:]
+        stack.append(result)
+        return pc + 1
+
+    def subtract(arg, pc):
+        x, y = stack.pop2()
+        stack.append(y - x)
+        return pc + 1
+
+    def multiply(arg, pc):
+        x, y = stack.pop2()
+        stack.append(y * x)
+        return pc + 1
+
+    def divide(arg, pc):
+        x, y = stack.pop2()
+        stack.append(y / x)
+        return pc + 1
+
+    def modulo(arg, pc):
+        x = stack.pop1()
+        y = stack.pop1()
+        stack.append(y % x)
+        return pc + 1
+
+    def power(arg, pc):
+        x, y = stack.pop2()
+        stack.append(y ** x)
+        return pc + 1
+
+    def less(arg, pc):
+        x = stack.pop1()
+        stack.append(int(stack.get_value() < x))
+        return pc + 1
+
+    def greater(arg, pc):
+        x = stack.pop1()
+        stack.append(int(stack.get_value() > x))
+        return pc + 1
+
+    def duplicate(arg, pc):
+        if stack:
+            stack.append(stack[-1])
+        return pc + 1
+
+    def duplicate_all(arg, pc):
+        if not stack:
+            dump_input()
+        check_growth(len(stack))
+        # a RangeStack copies its own segments, where a slice would take its ranges apart
+        stack.extend(stack if type(stack) is RangeStack else stack[:])
+        return pc + 1
+
+    def pop(arg, pc):
+        stack.pop_value(implicit=False)
+        return pc + 1
+
+    def pop_all(arg, pc):
+        del stack[:]
+        return pc + 1
+
+    def negate(arg, pc):
+        stack.append(int(stack.pop1() == 0))
+        return pc + 1
+
+    def load(arg, pc):
+        nonlocal stack
+        if type(backup) is RangeStack:
+            if type(stack) is not RangeStack:
+                stacks[stack_pointer] = stack = RangeStack(stack)
+            stack.extend(backup)
+        elif type(backup) == list:
+            stack.extend(backup)
+        elif backup is not None:
+            stack.append(backup)
+        else:
+            raise BackupCellError(
+                "attempted to load backup, but backup is empty")
+        return pc + 1
+
+    def save(arg, pc):
+        nonlocal backup
+        backup = stack.get_value()
+        return pc + 1
+
+    def save_all(arg, pc):
+        nonlocal backup
+        if not stack:
+            dump_input()
+        backup = RangeStack(stack) if type(stack) is RangeStack else stack[:]
+        return pc + 1
+
+    def swap(arg, pc):
+        x = stack.pop1()
+        y = stack.pop1()
+        stack.append(x)
+        stack.append(y)
+        return pc + 1
+
+    def move_left(arg, pc):
+        nonlocal stack, stack_pointer
+        if stack_pointer > 0:
+            stack_pointer -= 1
+        else:
+            # since this changes the indexing we don't need to decrement the pointer
+            stacks.prepend(new_stack())
+        stack = stacks[stack_pointer]
+        return pc + 1
+
+    def move_right(arg, pc):
+        nonlocal stack, stack_pointer
+        if stack_pointer + 1 == len(stacks):
+            stacks.append(new_stack())
+        stack_pointer += 1
+        stack = stacks[stack_pointer]
+        return pc + 1
+
+    def randomize(arg, pc):
+        x, y = stack.pop2()
+        stack.append(random.randint(y, x))
+        return pc + 1
+
+    def equal(arg, pc):
+        stack.append(int(stack.pop_value(implicit=False) == stack.get_value()))
+        return pc + 1
+
+    def size(arg, pc):
+        stack.append(len(stack))
+        return pc + 1
+
+    def length(arg, pc):
+        stack.append(len(str(stack.pop1())))
+        return pc + 1
+
+    def split(arg, pc):
+        for digit in str(stack.pop1()):
+            stack.append(int(digit))
+        return pc + 1
+
+    def join(arg, pc):
+        if not stack:
+            dump_input()
+        try:
+            x = int("".join(map(str, stack)))
+            del stack[:]
+            stack.append(x)
+        except TypeError:
+            raise EmptyStackError("cannot join an empty stack")
+        return pc + 1
+
+    def sort(arg, pc):
+        if not stack:
+            dump_input()
+        stack.sort()
+        return pc + 1
+
+    def negative(arg, pc):
+        stack.append(-stack.pop1())
+        return pc + 1
+
+    def index(arg, pc):
+        stack.append(stack[stack.pop_value(implicit=False)])
+        return pc + 1
+
+    def make_range(arg, pc):
+        nonlocal stack
+        x = stack.pop1()
+        y = stack.pop1()
+        values = range(y, x + 1)
+        check_growth(len(values))
+        if len(values) >= range_threshold and type(stack) is not RangeStack:
+            stacks[stack_pointer] = stack = RangeStack(stack)
+        stack.extend(values)
+        return pc + 1
+
+    def wait(arg, pc):
+        seconds = stack.pop1()
+        pause()
+        sleep(seconds)
+        return pc + 1
+
+    def swap_indices(arg, pc):
+        x = stack.pop_value(implicit=False)
+        y = stack.pop_value(implicit=False)
+        stack[y], stack[x] = stack[x], stack[y]
+        return pc + 1
+
+    def increment(arg, pc):
+        stack.append(stack.pop1() + 1)
+        return pc + 1
+
+    def decrement(arg, pc):
+        stack.append(stack.pop1() - 1)
+        return pc + 1
+
+    def contains(arg, pc):
+        value = stack.pop_value(implicit=False)
+        # contains may change the class of the stack, so it has to run before stack.append is looked up
+        found = stack.contains(value)
+        stack.append(int(found))
+        return pc + 1
+
+    dispatch = {
+        "nop": nop, "jump": jump, "end": end, "raise": fail, "push": push, "string": push_string,
+        "broken string": push_broken_string, "call": call, "[": loop_start, "]": loop_end, "$": skip,
+        ";": stop, "{": define, "i": read_chars, "n": read_number, "&n": read_numbers, "o": output_char,
+        "&o": output_chars, "u": output_number, "&u": output_numbers, "r": reverse, "+": add, "&+": add_all,
+        "-": subtract, "*": multiply, "/": divide, "%": modulo, "^": power, "L": less, "G": greater,
+        ":": duplicate, "&:": duplicate_all, "p": pop, "&p": pop_all, "!": negate, "l": load, "s": save,
+        "&s": save_all, "f": swap, "<": move_left, ">": move_right, "?": randomize, "=": equal, "y": size,
+        "c": length, "S": split, "J": join, "a": sort, "N": negative, "I": index, "R": make_range, "w": wait,
+        "W": swap_indices, "`": increment, ",": decrement, "~": contains, "print string": print_string,
+        "pop nonzero": pop_nonzero, "count down": count_down, "duplicate equal": duplicate_equal,
+    }
+
+    def bind(op):
+        opcode, arg = op
+        if opcode == "call":
+            char, fallback, fallback_arg, target = arg
+            arg = (char, dispatch[fallback], fallback_arg, target)
+        return (dispatch[opcode], arg)
+
+    bound = {}
+    bound_programs = {}
+
+    # returns the bound instructions, the decoded ones and their positions in the text of the program
+    def prepare(program):
+        if program not in bound_programs:
+            ops, positions = program.instructions(traced, optimization)
+            code = [bound[op] if op in bound else bound.setdefault(op, bind(op)) for op in ops]
+            if backend == "py":
+                code = program.transpiled(optimization, limited)(current, code, check_limits)
+            bound_programs[program] = (code, ops, positions, program.code)
+        return bound_programs[program]
+
+    # the stack transpiled code works on
+    def current():
+        return stack
+
+    # line and column in the source of an index into the running text, found through where each running function is defined
+    def locate(idx):
+        for frame in reversed(frames):
+            idx = body_positions(frame)[idx]
+        return program.locate(idx)
+
+    # where each character of the body of the function a frame called is in the text of the caller
+    def body_positions(frame):
+        caller_ops, caller_positions, caller_text, caller_functions, called = frame[1], frame[2], frame[3], frame[9], frame[10]
+        definition = (called, caller_functions[called])
+        pos = next(caller_positions[op] for op, (opcode, arg) in enumerate(caller_ops)
+                   if opcode == "{" and arg[:2] == definition)
+        # the body has its braces removed
+        result = []
+        while len(result) < len(definition[1]):
+            pos += 1
+            if caller_text[pos] not in "{}":
+                result.append(pos)
+        return result
+
+    def check_limits():
+        if steps_left == 0:
+            raise StepLimitError("program ran for more than {} instructions".format(max_steps))
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeLimitError("program ran for more than {} seconds".format(time_limit))
+        if max_stack_size is not None:
+            size = sum(map(len, stacks)) + sum(len(caller_stack) for frame in frames for caller_stack in frame[5])
+            if size > max_stack_size:
+                raise MemoryLimitError("program's stacks held more than {} values".format(max_stack_size))
+
+    # for instructions that can grow the stack a lot at once
+    def check_growth(count):
+        if max_stack_size is not None and len(stack) + count > max_stack_size:
+            raise MemoryLimitError("program's stacks held more than {} values".format(max_stack_size))
+
+    # sleeps, but not past the time limit
+    def sleep(seconds):
+        if deadline is not None and seconds > deadline - time.monotonic():
+            if requests is not None:
+                requests.append(("sleep", max(deadline - time.monotonic(), 0)))
+            else:
+                time.sleep(max(deadline - time.monotonic(), 0))
+            raise TimeLimitError("program ran for more than {} seconds".format(time_limit))
+        if requests is not None:
+            requests.append(("sleep", seconds))
+        else:
+            time.sleep(seconds)
+
+    code, ops, positions, text = prepare(program)
+    pc = 0
+    try:
+        if profile is not None:
+            profile.program = program
+            profile.bodies.setdefault(program.code, (None, range(len(program.code))))
+            timer = time.perf_counter
+            hits, times, opcode_hits, opcode_times = profile.hits, profile.times, profile.opcode_hits, profile.opcode_times
+            start = timer()
+            try:
+                while True:
+                    if limited:
+                        check_limits()
+                        if steps_left is not None:
+                            steps_left -= 1
+                    fn, arg = code[pc]
+                    opcode = ops[pc][0]
+                    # a jump the compiler added shares its index with the instruction before it
+                    key = (text, positions[pc] if opcode != "jump" else len(text))
+                    depth = len(frames)
+                    hits[key] = hits.get(key, 0) + 1
+                    opcode_hits[opcode] = opcode_hits.get(opcode, 0) + 1
+                    before = timer()
+                    pc = fn(arg, pc)
+                    elapsed = timer() - before
+                    times[key] = times.get(key, 0) + elapsed
+                    opcode_times[opcode] = opcode_times.get(opcode, 0) + elapsed
+                    if len(frames) > depth:
+                        name = frames[-1][10]
+                        profile.calls[name] = profile.calls.get(name, 0) + 1
+                        if text not in profile.bodies:
+                            caller_origins = profile.bodies[frames[-1][3]][1]
+                            profile.bodies[text] = (name, [caller_origins[pos] for pos in body_positions(frames[-1])])
+            finally:
+                profile.time += timer() - start
+        if trace is not None:
+            dirty = trace.dirty
+            step = 0
+            before = stack
+            caller = None
+            try:
+                while True:
+                    if limited:
+                        check_limits()
+                        if steps_left is not None:
+                            steps_left -= 1
+                    fn, arg = code[pc]
+                    opcode, op_arg = ops[pc]
+                    idx = positions[pc]
+                    before, size = stack, len(stack)
+                    caller, caller_size = caller_stack, len(caller_stack) if caller_stack is not None else 0
+                    caller_low = caller_size
+                    pc = fn(arg, pc)
+                    # the lowest index of each stack this could have changed
+                    if opcode in deep_rewrites or opcode == "call" and op_arg[1] in deep_rewrites:
+                        low = 0
+                    else:
+                        low = max(min(size - 3, len(before)), 0)
+                    mark = dirty.get(id(before))
+                    if mark is None:
+                        dirty[id(before)] = [before, low]
+                    elif low < mark[1]:
+                        mark[1] = low
+                    if caller is not None:
+                        low = min(caller_low, len(caller))
+                        mark = dirty.get(id(caller))
+                        if mark is None:
+                            dirty[id(caller)] = [caller, low]
+                        elif low < mark[1]:
+                            mark[1] = low
+                    step += 1
+                    if step % trace.sample == 0:
+                        trace.record(step, len(frames), idx, text[idx] if idx < len(text) else "",
+                                     stacks, stack_pointer, backup, frames)
+            finally:
+                # the step that stopped the program didn't get marked
+                dirty[id(before)] = [before, 0]
+                if caller is not None:
+                    dirty[id(caller)] = [caller, 0]
+                trace.record(step + 1, len(frames), positions[pc], text[positions[pc]] if positions[pc] < len(text) else "",
+                             stacks, stack_pointer, backup, frames)
+        if interval is not None:
+            # hands control back every interval instructions, after any that output or wait,
+            # and when one needs a line of input that hasn't arrived yet, in which case it runs again once it has
+            retrying = False
+            while True:
+                if limited:
+                    check_limits()
+                steps = interval if steps_left is None else min(interval, steps_left)
+                done = 0
+                while done < steps:
+                    fn, arg = code[pc]
+                    if delay and not retrying and positions[pc] != len(text) and ops[pc][0] != "jump":
+                        sleep(delay)
+                    # the values an instruction can take from a stack before it needs input
+                    before, saved, mark = stack, list(stack) if len(stack) < 4 else None, program_input.position
+                    try:
+                        pc = fn(arg, pc)
+                    except InputPending:
+                        if saved is not None:
+                            while before:
+                                before.pop()
+                            before.extend(saved)
+                        program_input.position = mark
+                        retrying = True
+                        break
+                    retrying = False
+                    done += 1
+                    if requests:
+                        break
+                if steps_left is not None:
+                    steps_left -= done
+                yield "input" if retrying else None
+        if not traced:
+            if not limited:
+                while True:
+                    fn, arg = code[pc]
+                    pc = fn(arg, pc)
+            while True:
+                check_limits()
+                steps = limit_interval if steps_left is None else min(limit_interval, steps_left)
+                for _ in range(steps):
+                    fn, arg = code[pc]
+                    pc = fn(arg, pc)
+                if steps_left is not None:
+                    steps_left -= steps
+        while True:
+            if limited:
+                check_limits()
+                if steps_left is not None:
+                    steps_left -= 1
+            fn, arg = code[pc]
+            idx = positions[pc]
+            if idx == len(text) or ops[pc][0] == "jump":
+                # not a character of the program
+                pc = fn(arg, pc)
+                continue
+            if delay:
+                pause()
+                sleep(delay)
+            if debug:
+                print(" | ".join([text[idx], str(stacks), str(backup), getattr(output_function, "__name__", type(output_function).__name__), str(idx - 1), str(stack_pointer)]), end=(
+                    "\n" if not step_by_step else ""))
+            pc = fn(arg, pc)
+            if step_by_step:
+                pause()
+                input()
+    except Halt as halt:
+        if halt.args[0] is not None:
+            return halt.args[0]
+    except errors as err:
+        pause()
+        if backend == "py":
+            pc = transpiled_pc(err.__traceback__, pc)
+        idx = positions[pc]
+        on_error(err, idx, text[idx], *locate(idx), frames[-1][10] if frames else None)
+        return False
+    finally:
+        if debug and calls is not None:
+            for name in sorted(calls.hits.keys() | calls.misses.keys()):
+                print("calls to {} remembered: {} hits, {} misses".format(
+                    name, calls.hits.get(name, 0), calls.misses.get(name, 0)))
+
+    if debug:
+        print("outputting implicitly")
+    output_function(" ".join(map(str, stack)))
+    return True
+
+
+# the input of a program run by interpret_async, handing out the lines that have arrived so far
+# position can be set back to give out the lines from there again
+class PendingInput:
+
+    def __init__(self):
+        self.lines = []
+        self.position = 0
+        self.ended = False
+
+    def __call__(self):
+        if self.position < len(self.lines):
+            self.position += 1
+            return self.lines[self.position - 1]
+        if self.ended:
+            raise EOFError
+        raise InputPending
+
+    # a run of lines is read until an empty one
+    def prefetch(self):
+        if not self.ended and "" not in self.lines[self.position:]:
+            raise InputPending
+
+    def add(self, line):
+        # lines handed out for good aren't needed any more
+        if self.position > 1024:
+            del self.lines[:self.position]
+            self.position = 0
+        self.lines.append(line)
+
+
+# runs a program as a coroutine, so that many of them can share one event loop
+# input_function and output_function are coroutine functions, input_function returns a line like the builtin input,
+# and raises EOFError once there are none left, the other options are those of interpret other than debug,
+# step_by_step, profile and trace
+# waiting, for time or input, lets other tasks run, and so does every interval instructions
+async def interpret_async(program, input_function, output_function, *, interval=1000, on_error=print_error, **options):
+    program_input = PendingInput()
+    requests = []
+    run = execute(program, program_input, lambda val: requests.append(("output", val)), interval=interval,
+                  requests=requests, on_error=lambda *report: requests.append(("error", report)), **options)
+    while True:
+        try:
+            need = next(run)
+        except StopIteration as stop:
+            result, need = stop.value, "result"
+        for kind, value in requests:
+            if kind == "output":
+                await output_function(value)
+            elif kind == "sleep":
+                await asyncio.sleep(value)
+            else:
+                on_error(*value)
+        requests.clear()
+        if need == "result":
+            return result
+        if need == "input":
+            try:
+                program_input.add(await input_function())
+            except EOFError:
+                program_input.ended = True
+        else:
+            await asyncio.sleep(0)
+
+
+# reads a program's input in large blocks and hands it out a line at a time, like the builtin input
+class Input:
+
+    # files at least this large are memory mapped instead of read
+    mmap_size = 1 << 24
+
+    def __init__(self, file=None, *, encoding=None, errors=None, block_size=1 << 16):
+        self.lines = []
+        self.next_line = 0
+        self.rest = ""
+        self.blocks = iter(())
+        if file is not None:
+            binary = getattr(file, "buffer", file)
+            encoding = encoding or getattr(file, "encoding", None) or "utf-8"
+            errors = errors or getattr(file, "errors", None) or "strict"
+            # read1 returns what is available, so interactive input isn't held up waiting for a whole block
+            read = getattr(binary, "read1", binary.read)
+            self.blocks = iter(lambda: read(block_size), b"")
+        decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors or "strict")
+        self.decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+
+    @classmethod
+    def from_text(cls, text):
+        self = cls()
+        *self.lines, self.rest = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        return self
+
+    @classmethod
+    def from_path(cls, path, *, encoding="utf-8", errors="strict", block_size=1 << 20):
+        file = open(path, "rb")
+        if os.fstat(file.fileno()).st_size < cls.mmap_size:
+            return cls(file, encoding=encoding, errors=errors, block_size=block_size)
+        with file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self = cls(encoding=encoding, errors=errors)
+        self.blocks = (data[pos:pos + block_size] for pos in range(0, len(data), block_size))
+        return self
+
+    # reads until there is a line to hand out, returns False at the end of the input
+    def fill(self):
+        while self.next_line == len(self.lines):
+            if self.decoder is None:
+                return False
+            block = next(self.blocks, b"")
+            if block:
+                *self.lines, self.rest = (self.rest + self.decoder.decode(block)).split("\n")
+            else:
+                rest = self.rest + self.decoder.decode(b"", final=True)
+                self.lines = [rest] if rest else []
+                self.rest = ""
+                self.decoder = None
+            self.next_line = 0
+        return True
+
+    def __call__(self):
+        if self.next_line == len(self.lines) and not self.fill():
+            raise EOFError
+        line = self.lines[self.next_line]
+        self.next_line += 1
+        return line
+
+    # reads lines as integers up to the next empty line or the end of the input
+    # returns the integers and whether it got there, rather than stopping at a line that isn't one
+    def numbers(self):
+        values = []
+        while self.fill():
+            lines = self.lines
+            start = self.next_line
+            try:
+                end = lines.index("", start)
+            except ValueError:
+                end = len(lines)
+            try:
+                # converted in full before any are added, += on the map would keep the ones before a bad line
+                values += list(map(int, lines[start:end]))
+            except ValueError:
+                for line in lines[start:end]:
+                    self.next_line += 1
                     try:
-                        stack.add_value(int(take_input()))
+                        values.append(int(line))
                     except ValueError:
-                        raise InputError(
-                            "program expected integer input, got string instead")
-            elif char == "o":
-                if last == "&":
-                    if not stack:
-                        for char in take_input():
-                            stack.add_value(ord(char))
-                    for val in stack[:]:
-                        output_function(chr(val))
-                        stack.pop_value(implicit=False)
-                else:
-                    output_function(chr(stack.pop_value(implicit=False)))
-            elif char == "u":
-                if last == "&":
-                    if not stack:
-                        dump_input()
-                    output_function("\n".join([str(x) for x in stack[:]]))
-                    for _ in stack[:]:
-                        stack.pop_value(implicit=False)
-                else:
-                    output_function(stack.pop_value(implicit=False))
-            elif char == "r":
-                if not stack:
-                    dump_input()
-                stack.reverse()
-            elif char == "+":
-                if last == "&":
-                    if not stack:
-                        dump_input()
-                    result = sum(stack)
-                    for _ in stack[:]:
-                        stack.pop_value(implicit=False)
-                    stack.add_value(result)
-                else:
-                    x, y = stack.pop_value(2)
-                    stack.add_value(y + x)
-            elif char == "-":
-                x, y = stack.pop_value(2)
-                stack.add_value(y - x)
-            elif char == "*":
-                x, y = stack.pop_value(2)
-                stack.add_value(y * x)
-            elif char == "/":
-                x, y = stack.pop_value(2)
-                stack.add_value(y / x)
-            elif char == "%":
-                x = stack.pop_value()
-                y = stack.pop_value()
-                stack.add_value(y % x)
-            elif char == "^":
-                x, y = stack.pop_value(2)
-                stack.add_value(y ** x)
-            elif char == "L":
-                x = stack.pop_value()
-                stack.add_value(int(stack.get_value() < x))
-            elif char == "G":
-                x = stack.pop_value()
-                stack.add_value(int(stack.get_value() > x))
-            elif char == '"':
-                for pos, char in enumerate(program[idx + 1:]):
-                    # print("Char: " + char)
-                    if char == '"':
-                        if program[idx + pos] == "\\":
-                            stack.add_value(ord(char))
-                        else:
-                            # print("Position: " + str(pos))
-                            idx += pos + 1
-                            break
-                    elif char == "n":
-                        if program[idx + pos] == "\\":
-                            stack.add_value(ord('\n'))
-                        else:
-                            stack.add_value(ord(char))
-                    elif char == "\\" and program[idx + pos + 2] in ['"', 'n']:
-                        pass
-                    elif 0xFDD0 <= ord(char) < 0xFDD0 + len(brackets):
-                        stack.add_value(ord(brackets[ord(char) - 0xFDD0]))
-                    else:
-                        stack.add_value(ord(char))
-            elif char == ";":
+                        return values, False
+            if end < len(lines):
+                self.next_line = end + 1
+                return values, True
+            self.next_line = end
+        return values, True
+
+
+# buffers what a program outputs and writes it to file in larger pieces
+# flush is "always", "newline", "input" (whenever the program waits for input or sleeps), "never",
+# or the number of characters to collect before writing, at most buffer_size characters are held either way
+class Output:
+
+    def __init__(self, file=None, flush="input", buffer_size=65536):
+        self.file = sys.stdout if file is None else file
+        self.flush_policy = flush
+        self.buffer_size = min(flush, buffer_size) if type(flush) == int else buffer_size
+        self.always = flush == "always"
+        self.newline = flush == "newline"
+        self.pending = []
+        self.size = 0
+        # text files get the encoded text written straight to their binary buffer
+        self.binary = getattr(self.file, "buffer", None)
+        self.encoding = getattr(self.file, "encoding", None) or "utf-8"
+        self.errors = getattr(self.file, "errors", None) or "strict"
+
+    def __call__(self, val):
+        text = str(val)
+        self.pending.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size or self.always or (self.newline and "\n" in text):
+            self.flush()
+
+    def flush(self):
+        text = "".join(self.pending)
+        self.pending = []
+        self.size = 0
+        if self.binary is not None:
+            # anything printed through the text layer has to come out first
+            self.file.flush()
+            self.binary.write(text.encode(self.encoding, self.errors))
+            self.binary.flush()
+        else:
+            self.file.write(text)
+            self.file.flush()
+
+    def pause(self):
+        if self.flush_policy != "never" and self.pending:
+            self.flush()
+
+    def close(self):
+        if self.pending:
+            self.flush()
+
+
+# what a program spent its time on, filled in by interpret
+# instructions are counted by the text they're in (the program's, or a function body) and their index there
+class Profile:
+
+    def __init__(self):
+        self.program = None
+        self.time = 0
+        self.hits = {}
+        self.times = {}
+        self.opcode_hits = {}
+        self.opcode_times = {}
+        self.calls = {}
+        # function bodies that ran, with the function name and the index in the program of each character
+        self.bodies = {}
+        # the CallCache of a run that remembered calls
+        self.memoized = None
+
+    def to_json(self):
+        instructions = []
+        loops = []
+        functions = {}
+        for (text, idx), hits in self.hits.items():
+            # the end of a text, where jumps the compiler added are counted too, isn't a character of the program
+            if idx == len(text):
+                continue
+            name, origins = self.bodies[text]
+            line, column = self.program.locate(origins[idx])
+            entry = {"function": name, "index": idx, "instruction": text[idx], "line": line, "column": column,
+                     "hits": hits, "time": self.times.get((text, idx), 0)}
+            instructions.append(entry)
+            if text[idx] == "]":
+                jumps = self.program.jumps if name is None else self.program.function(text).jumps
+                loops.append({"function": name, "start": jumps[idx], "end": idx, "line": line,
+                              "column": column, "iterations": hits})
+            if name is not None:
+                function = functions.setdefault(name, {"name": name, "calls": self.calls.get(name, 0),
+                                                       "instructions": 0, "time": 0})
+                function["instructions"] += hits
+                function["time"] += entry["time"]
+        instructions.sort(key=lambda entry: entry["time"], reverse=True)
+        loops.sort(key=lambda entry: entry["iterations"], reverse=True)
+        return {
+            "time": self.time,
+            "instructions": sum(self.opcode_hits.values()),
+            "opcodes": sorted(({"opcode": opcode, "hits": hits, "time": self.opcode_times.get(opcode, 0)}
+                               for opcode, hits in self.opcode_hits.items()), key=lambda entry: entry["time"], reverse=True),
+            "indices": instructions,
+            "loops": loops,
+            "functions": sorted(functions.values(), key=lambda entry: entry["time"], reverse=True),
+            "memoized": [] if self.memoized is None else [
+                {"name": name, "hits": self.memoized.hits.get(name, 0), "misses": self.memoized.misses.get(name, 0)}
+                for name in sorted(self.memoized.hits.keys() | self.memoized.misses.keys())],
+        }
+
+    # the JSON profile as text, with the top entries of each table
+    def report(self, top=20):
+        profile = self.to_json()
+        lines = ["{} instructions in {:.6f} seconds".format(profile["instructions"], profile["time"]), "",
+                 "{:<14} {:>12} {:>12} {:>7}".format("opcode", "hits", "seconds", "%")]
+        total = sum(entry["time"] for entry in profile["opcodes"]) or 1
+        for entry in profile["opcodes"][:top]:
+            lines.append("{:<14} {:>12} {:>12.6f} {:>6.1f}%".format(
+                entry["opcode"], entry["hits"], entry["time"], 100 * entry["time"] / total))
+        lines += ["", "{:<14} {:<11} {:>12} {:>12} {:>7}".format("line:column", "instruction", "hits", "seconds", "%")]
+        for entry in profile["indices"][:top]:
+            where = "{}:{}".format(entry["line"], entry["column"])
+            if entry["function"] is not None:
+                where += " in " + entry["function"]
+            lines.append("{:<14} {:<11} {:>12} {:>12.6f} {:>6.1f}%".format(
+                where, repr(entry["instruction"]), entry["hits"], entry["time"], 100 * entry["time"] / total))
+        if profile["loops"]:
+            lines += ["", "{:<14} {:>12}".format("loop ending at", "iterations")]
+            for entry in profile["loops"][:top]:
+                where = "{}:{}".format(entry["line"], entry["column"])
+                if entry["function"] is not None:
+                    where += " in " + entry["function"]
+                lines.append("{:<14} {:>12}".format(where, entry["iterations"]))
+        if profile["functions"]:
+            lines += ["", "{:<14} {:>12} {:>12} {:>12}".format("function", "calls", "instructions", "seconds")]
+            for entry in profile["functions"][:top]:
+                lines.append("{:<14} {:>12} {:>12} {:>12.6f}".format(
+                    entry["name"], entry["calls"], entry["instructions"], entry["time"]))
+        if profile["memoized"]:
+            lines += ["", "{:<14} {:>12} {:>12}".format("remembered", "hits", "misses")]
+            for entry in profile["memoized"]:
+                lines.append("{:<14} {:>12} {:>12}".format(entry["name"], entry["hits"], entry["misses"]))
+        return "\n".join(lines)
+
+
+# instructions that can change a stack below the few values at its top
+deep_rewrites = {"r", "a", "J", "&+", "W"}
+
+# instructions that do more than work on the stacks, which a function can only be remembered without
+impure = {"?", "w"}
+
+
+# remembers what calls of pure functions took from their caller's stack and gave back to it, for interpret's memoize
+# option, keeping the size most recently used calls
+# a call is keyed by the function body and what it took, as the text of each value and None where the stack ran out
+class CallCache:
+
+    def __init__(self, size):
+        self.size = size
+        self.calls = collections.OrderedDict()
+        # how many values calls of each body have taken, which are the only ones worth looking up
+        self.lengths = {}
+        self.purity = {}
+        self.hits = {}
+        self.misses = {}
+
+    # whether a function only works on the stacks, so the same arguments always give the same results
+    def pure(self, function):
+        if function.code not in self.purity:
+            ops, _ = function.instructions()
+            self.purity[function.code] = not any(
+                opcode in impure or opcode == "call" and arg[1] in impure for opcode, arg in ops)
+        return self.purity[function.code]
+
+    # returns how many values to pop from stack and the values to push onto it instead of calling the function,
+    # if a call has been remembered with the same arguments
+    def find(self, name, body, stack):
+        for length in self.lengths.get(body, ()):
+            key = [str(stack[-1 - idx]) for idx in range(min(length, len(stack)))]
+            if len(stack) < length:
+                key.append(None)
+            produced = self.calls.get((body, tuple(key)))
+            if produced is not None:
+                self.calls.move_to_end((body, tuple(key)))
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return len(key) - (key[-1:] == [None]), produced
+        self.misses[name] = self.misses.get(name, 0) + 1
+        return None
+
+    def add(self, body, taken, produced):
+        self.calls[body, tuple(taken)] = produced
+        self.lengths.setdefault(body, set()).add(len(taken))
+        if len(self.calls) > self.size:
+            self.calls.popitem(last=False)
+
+
+# records a program's steps as the changes they make to the stacks, instead of whole copies of them
+# every sample-th step is written to file, a binary file, as a marshalled record, or kept in memory
+# in a ring of the last ring_size records (with the full state every keyframe_interval records to start from)
+# lytrace.py rebuilds the state at any step from what this writes
+class Trace:
+
+    version = 1
+
+    def __init__(self, file=None, *, sample=1, ring_size=None, keyframe_interval=10000):
+        self.file = file
+        self.sample = sample
+        self.ring = None if ring_size is None else collections.deque(maxlen=ring_size)
+        # the ring always holds a keyframe to start from
+        self.keyframe_interval = keyframe_interval if ring_size is None else max(min(keyframe_interval, ring_size // 2), 1)
+        self.records = 0
+        self.stacks_seen = 0
+        # id of each stack that may have changed since the last record, with the stack and the lowest index that may have
+        self.dirty = {}
+        # id of each stack recorded so far, with its number in the trace, its contents as last recorded and the stack
+        self.known = {}
+        # the stack numbers, stacks list and backup of the program and each running function, as last recorded
+        self.orders = []
+        self.layouts = []
+        self.pointers = []
+        self.backups = []
+        if file is not None and self.ring is None:
+            marshal.dump(("ly-trace", self.version, sample, False), file)
+
+    def record(self, step, depth, idx, char, stacks, pointer, backup, frames):
+        if self.ring is not None and self.records % self.keyframe_interval == 0:
+            self.ring.append(self.keyframe(step, stacks, pointer, backup, frames))
+        elif self.callers_changed(frames):
+            self.write(self.keyframe(step, stacks, pointer, backup, frames))
+        self.records += 1
+        known = self.known
+        deltas = []
+        for stack, low in self.dirty.values():
+            entry = known.get(id(stack))
+            if entry is None:
+                continue
+            number, shadow, _ = entry
+            end = min(len(shadow), len(stack))
+            keep = min(low, end)
+            while keep < end and type(shadow[keep]) is type(stack[keep]) and shadow[keep] == stack[keep]:
+                keep += 1
+            if keep < len(shadow) or keep < len(stack):
+                values = stack[keep:]
+                shadow[keep:] = values
+                deltas.append((number, keep, tuple(values)))
+        self.dirty.clear()
+        orders, layouts, backups = self.orders, self.layouts, self.backups
+        if depth < len(orders) - 1 or depth < len(orders) and layouts[depth][0] is not stacks:
+            # the functions these stacks belonged to have returned
+            live = {id(stack) for frame in frames for stack in frame[5]} | {id(stack) for stack in stacks}
+            for key in [key for key in known if key not in live]:
+                del known[key]
+            del orders[depth + 1:], layouts[depth + 1:], self.pointers[depth + 1:], backups[depth + 1:]
+        if depth == len(orders):
+            orders.append(None)
+            layouts.append((None, 0))
+            self.pointers.append(0)
+            backups.append(None)
+        # a running function's stacks only change by one being added or replaced
+        if layouts[depth][0] is stacks and layouts[depth][1] == stacks.changes:
+            order = None
+        else:
+            layouts[depth] = (stacks, stacks.changes)
+            order = tuple(self.number(stack, deltas) for stack in stacks)
+            if order == orders[depth]:
+                order = None
+            else:
+                orders[depth] = order
+        # backup is None, a value or a list
+        changed = backup is not backups[depth]
+        if changed:
+            backups[depth] = backup
+        self.pointers[depth] = pointer
+        self.write((step, depth, idx, char, order, pointer, changed, freeze(backup) if changed else None, tuple(deltas)))
+
+    # whether the stacks, pointer or backup of a caller changed since they were last recorded, which happens when
+    # the steps that changed them weren't sampled, as a record only has those of the level running it
+    def callers_changed(self, frames):
+        for level, frame in enumerate(frames):
+            if level >= len(self.layouts):
                 return True
-            elif char == ":":
-                if last == "&":
-                    if not stack:
-                        dump_input()
-                    for val in stack[:]:
-                        stack.add_value(val)
-                else:
-                    val = stack.get_value()
-                    if val is not None:
-                        stack.add_value(val)
-            elif char == "p":
-                if last == "&":
-                    for _ in stack[:]:
-                        stack.pop_value(implicit=False)
-                else:
-                    stack.pop_value(implicit=False)
-            elif char == "!":
-                if stack.pop_value() == 0:
-                    stack.add_value(1)
-                else:
-                    stack.add_value(0)
-            elif char == "l":
-                if type(backup) == list:
-                    for item in backup[:]:
-                        stack.add_value(item)
-                elif backup is not None:
-                    stack.add_value(backup)
-                else:
-                    raise BackupCellError(
-                        "attempted to load backup, but backup is empty")
-            elif char == "s":
-                if last == "&":
-                    if not stack:
-                        dump_input()
-                    backup = stack[:]
-                else:
-                    backup = stack.get_value()
-            elif char == "f":
-                x = stack.pop_value()
-                y = stack.pop_value()
-                stack.add_value(x)
-                stack.add_value(y)
-            elif char == "<":
-                if stack_pointer > 0:
-                    stack_pointer -= 1
-                else:
-                    # since this changes the indexing we don't need to decrement the pointer
-                    stacks.insert(0, Stack())
-                stack = stacks[stack_pointer]
-            elif char == ">":
-                try:
-                    stacks[stack_pointer + 1]
-                except IndexError:
-                    stacks.append(Stack())
-                stack_pointer += 1
-                stack = stacks[stack_pointer]
-            elif char == "$":
-                for _ in range(stack.pop_value(implicit=False)):
-                    extra = 0
-                    for pos, char in enumerate(program[idx + 1:]):
-                        # print("Char: " + char)
-                        if char == "[":
-                            extra += 1
-                        elif char == "]":
-                            if extra:
-                                extra -= 1
-                            else:
-                                # print("Position: " + str(pos))
-                                idx += pos + 1
-                                break
-            elif char == "?":
-                x, y = stack.pop_value(2)
-                stack.add_value(random.randint(y, x))
-            elif char == "{":
-                function_name = last
-                function_body = ""
-                extra = 0
-                for pos, char in enumerate(program[idx + 1:]):
-                    # print("Char: " + char)
-                    if char == "{":
-                        extra += 1
-                    elif char == "}":
-                        if extra:
-                            extra -= 1
-                        else:
-                            # print("Position: " + str(pos))
-                            idx += pos
-                            break
-                    else:
-                        function_body += char
-                if "i" in function_body:
-                    raise FunctionError("functions cannot contain the 'i' instruction")
-                functions[function_name] = function_body
-            elif char == "=":
-                if stack.pop_value(implicit=False) == stack.get_value():
-                    stack.add_value(1)
-                else:
-                    stack.add_value(0)
-            elif char == "(":
-                body = ""
-                extra = 0
-                for pos, char in enumerate(program[idx + 1:]):
-                    # print("Char: " + char)
-                    if char == "(":
-                        extra += 1
-                    elif char == ")":
-                        if extra:
-                            extra -= 1
-                        else:
-                            # print("Position: " + str(pos))
-                            idx += pos
-                            break
-                    elif char.isdigit():
-                        body += char
-                try:
-                    stack.add_value(int(body))
-                except ValueError:
-                    pass
-            elif char == "y":
-                stack.add_value(len(stack))
-            elif char == "c":
-                stack.add_value(len(str(stack.pop_value())))
-            elif char == "S":
-                x = str(stack.pop_value())
-                for digit in x:
-                    stack.add_value(int(digit))
-            elif char == "J":
-                if not stack:
-                    dump_input()
-                try:
-                    x = int("".join([str(x) for x in stack]))
-                    for _ in stack[:]:
-                        stack.pop_value()
-                    stack.add_value(x)
-                except TypeError:
-                    raise EmptyStackError("cannot join an empty stack")
-            elif char == "a":
-                if not stack:
-                    dump_input()
-                stack.sort()
-            elif char == "N":
-                stack.add_value(-stack.pop_value())
-            elif char == "I":
-                stack.add_value(stack[stack.pop_value(implicit=False)])
-            elif char == "R":
-                x = stack.pop_value()
-                y = stack.pop_value()
-                for i in range(y, x + 1):
-                    stack.add_value(i)
-            elif char == "'":
-                if 0xFDD0 <= ord(next) < 0xFDD0 + len(brackets):
-                    stack.add_value(ord(brackets[ord(next) - 0xFDD0]))
-                else:
-                    stack.add_value(ord(next))
-                idx += 1
-            elif char == "w":
-                time.sleep(stack.pop_value())
-            elif char == "W":
-                x = stack.pop_value(implicit=False)
-                y = stack.pop_value(implicit=False)
-                stack[y], stack[x] = stack[x], stack[y]
-            elif char == "`":
-                stack.add_value(stack.pop_value() + 1)
-            elif char == ",":
-                stack.add_value(stack.pop_value() - 1)
-            elif char == "~":
-                stack.add_value(int(stack.pop_value(implicit=False) in stack))
-        except errors as err:
-            if output_function.__name__ == "function_execution":
-                raise FunctionError("{}: {}$${}$${}".format(
-                    type(err).__name__, str(err), str(idx), char))
-            print("Error occurred at program index {}, instruction {} (zero-indexed, excludes comments)".format(idx, char), file=sys.stderr)
-            print(type(err).__name__, str(err), sep=": ", file=sys.stderr)
+            stacks, changes = self.layouts[level]
+            if (stacks is not frame[5] or changes != frame[5].changes or self.pointers[level] != frame[7]
+                    or self.backups[level] is not frame[8]):
+                return True
+        return False
+
+    # the number of a stack in the trace, recording its contents the first time it's seen
+    def number(self, stack, deltas):
+        entry = self.known.get(id(stack))
+        if entry is None:
+            entry = self.known[id(stack)] = (self.stacks_seen, list(stack), stack)
+            self.stacks_seen += 1
+            if stack:
+                deltas.append((entry[0], 0, tuple(stack)))
+        return entry[0]
+
+    # everything needed to rebuild the state from this point, without the records before it
+    def keyframe(self, step, stacks, pointer, backup, frames):
+        levels = [(frame[5], frame[7], frame[8]) for frame in frames] + [(stacks, pointer, backup)]
+        for level_stacks, _, _ in levels:
+            for stack in level_stacks:
+                self.number(stack, [])
+        for stack, _ in self.dirty.values():
+            if id(stack) in self.known:
+                self.known[id(stack)][1][:] = stack
+        self.dirty.clear()
+        self.orders = [tuple(self.number(stack, []) for stack in level_stacks) for level_stacks, _, _ in levels]
+        self.layouts = [(level_stacks, level_stacks.changes) for level_stacks, _, _ in levels]
+        self.pointers = [level_pointer for _, level_pointer, _ in levels]
+        self.backups = [level_backup for _, _, level_backup in levels]
+        contents = {number: tuple(shadow) for number, shadow, _ in self.known.values()}
+        return ("keyframe", step, tuple((order, level_pointer, freeze(level_backup))
+                                        for order, (_, level_pointer, level_backup) in zip(self.orders, levels)), contents)
+
+    def write(self, record):
+        if self.ring is not None:
+            self.ring.append(record)
+        elif self.file is not None:
+            marshal.dump(record, self.file)
+
+    # writes out the ring, if the trace is kept in one
+    def close(self):
+        if self.ring is not None and self.file is not None:
+            marshal.dump(("ly-trace", self.version, self.sample, True), self.file)
+            for record in self.ring:
+                marshal.dump(record, self.file)
+
+
+# a backup that is a list, or a RangeStack, as a tuple
+def freeze(value):
+    return value if value is None or type(value) in (int, float) else tuple(value)
+
+
+# a program that has been parsed and compiled once, and can be run any number of times
+class Program:
+
+    def __init__(self, source, *, preprocessed=False):
+        self.source = source
+        if preprocessed:
+            self.code, self.source_map = source, ([0], [0])
+        else:
+            self.code, self.source_map = preprocess(source)
+        try:
+            self.jumps = find_jumps(self.code)
+        except ParseError as err:
+            raise ParseError("Unmatched brackets in program, at line {}, column {}".format(
+                *self.locate(err.args[1]))) from None
+        self.compiled = {}
+        self.python = {}
+        self.functions = {}
+        # what was compiled when the program was loaded from a cache, so it is only written back if that grew
+        self.stored = None
+
+    # line and column in the source, both counted from 1, of an index into the preprocessed program
+    def locate(self, idx):
+        starts, origins = self.source_map
+        segment = bisect.bisect_right(starts, idx) - 1
+        pos = origins[segment] + idx - starts[segment]
+        return self.source.count("\n", 0, pos) + 1, pos - self.source.rfind("\n", 0, pos)
+
+    # function bodies are compiled the first time they are defined, then reused
+    def function(self, body):
+        if body not in self.functions:
+            self.functions[body] = Program(body, preprocessed=True)
+        return self.functions[body]
+
+    def instructions(self, traced=False, optimization=0):
+        if (traced, optimization) not in self.compiled:
+            ops, positions = compile_program(self.code, self.jumps, skip_noops=not traced)
+            self.compiled[traced, optimization] = optimize_program(ops, positions, optimization)
+        return self.compiled[traced, optimization]
+
+    # returns the build function of the Python transpile makes of the program, compiled once and then reused
+    def transpiled(self, optimization=0, limited=False):
+        if (optimization, limited) not in self.python:
+            ops, _ = self.instructions(False, optimization)
+            source, lines = transpile(ops, limited)
+            # compile on its own is the one in this module
+            self.python[optimization, limited] = (builtins.compile(source, "<ly program>", "exec"), lines)
+        code, lines = self.python[optimization, limited]
+        namespace = {"ly_lines": lines}
+        exec(code, namespace)
+        return namespace["build"]
+
+    # everything compiled for the program and its functions so far, as values marshal can write
+    def state(self):
+        return {"code": self.code, "source_map": self.source_map, "jumps": self.jumps,
+                "compiled": {key: (ops, positions.tobytes()) for key, (ops, positions) in self.compiled.items()},
+                "python": self.python, "functions": {body: function.state() for body, function in self.functions.items()}}
+
+    @classmethod
+    def from_state(cls, source, state):
+        program = cls.__new__(cls)
+        program.source = source
+        program.code, program.source_map, program.jumps = state["code"], state["source_map"], state["jumps"]
+        program.compiled = {key: (ops, array("q", positions)) for key, (ops, positions) in state["compiled"].items()}
+        program.python = state["python"]
+        program.functions = {body: cls.from_state(body, function) for body, function in state["functions"].items()}
+        program.stored = program.contents()
+        return program
+
+    # the forms compiled so far, to tell whether a stored program is missing any
+    def contents(self):
+        return (set(self.compiled), set(self.python),
+                {body: function.contents() for body, function in self.functions.items()})
+
+    # run, with interpret_async, input is the text to read from or a coroutine function returning one line per call,
+    # and output a coroutine function called with everything the program outputs, by default it is collected
+    async def run_async(self, input="", output=None, **options):
+        if isinstance(input, str):
+            read_line = Input.from_text(input)
+
+            async def input():
+                return read_line()
+        collected = []
+        if output is None:
+            async def output(val):
+                collected.append(str(val))
+        result = await interpret_async(self, input, output, **options)
+        return "".join(collected), int(not result)
+
+    # input is the text to read from, or a function returning one line per call like the builtin input
+    # output is a function called with everything the program outputs, by default it is collected
+    # returns the collected output and the exit status
+    def run(self, input="", output=None, *, debug=False, delay=0, step_by_step=False,
+            max_steps=None, time_limit=None, max_stack_size=None, profile=None, trace=None, compact_stacks=False,
+            optimization=2, backend="interpreter", memoize=0):
+        input_function = Input.from_text(input) if isinstance(input, str) else input
+        collected = []
+        if output is None:
+            def output(val):
+                collected.append(str(val))
+        result = interpret(self, input_function, output, debug=debug, delay=delay, step_by_step=step_by_step,
+                           max_steps=max_steps, time_limit=time_limit, max_stack_size=max_stack_size, profile=profile,
+                           trace=trace, compact_stacks=compact_stacks, optimization=optimization, backend=backend,
+                           memoize=memoize)
+        return "".join(collected), int(not result)
+
+
+def compile(source):
+    return Program(source)
+
+
+interpreter_hash = None
+
+
+# changes whenever this file or the Python running it does, as code objects and compiled forms are only good for both
+def get_interpreter_hash():
+    global interpreter_hash
+    if interpreter_hash is None:
+        with open(__file__, "rb") as file:
+            interpreter_hash = hashlib.sha256(file.read() + sys.version.encode()).hexdigest()
+    return interpreter_hash
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ly")
+
+
+# keeps compiled programs in a directory between runs, one marshalled file per program named by a hash of its source
+# and of the interpreter, and removes the least recently used files once they take up more than max_size bytes
+# a file that can't be read is treated as missing, and failing to write one never stops a run
+class ProgramCache:
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, source):
+        digest = hashlib.sha256((get_interpreter_hash() + source).encode("utf-8", "surrogatepass")).hexdigest()
+        return os.path.join(self.directory, digest + ".ly-cache")
+
+    def load(self, source):
+        path = self.path(source)
+        try:
+            with open(path, "rb") as file:
+                stored_source, state = marshal.load(file)
+            if stored_source != source:
+                return None
+            program = Program.from_state(source, state)
+            # the modification time is when the file was last used
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return None
+        return program
+
+    # returns whether the program was written, which it isn't when everything compiled for it already was
+    def store(self, program):
+        if program.stored == program.contents():
+            # the directory may have been filled under a larger max_size than this one
+            self.evict()
+            return False
+        path = self.path(program.source)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, "wb") as file:
+                marshal.dump((program.source, program.state()), file)
+            os.replace(temporary, path)
+        except (OSError, ValueError):
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
             return False
-        idx += 1
-        if step_by_step:
-            input()
+        program.stored = program.contents()
+        self.evict()
+        return True
 
-    if debug:
-        print("outputting implicitly")
-    if output_function.__name__ == "function_execution":
-        for val in stack:
-            output_function(val)
+    def evict(self):
+        entries = []
+        try:
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if entry.name.endswith(".ly-cache"):
+                        info = entry.stat()
+                        entries.append((info.st_mtime, info.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+# batch mode runs one program against many inputs in a pool of worker processes
+
+class CaseTimeout(Exception):
+    pass
+
+
+batch_program = None
+
+
+def start_batch_worker(program):
+    global batch_program
+    batch_program = program
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, stop_case)
+
+
+def stop_case(signum, frame):
+    raise CaseTimeout
+
+
+# runs one case in a worker and returns its result, ready to be written out as JSON
+# the program is the batch's unless another one is given, and options are passed on to interpret
+def run_case(case, program=None, **options):
+    if program is None:
+        program = batch_program
+    name, text, timeout, max_steps, max_stack_size = case
+    output = []
+    error = None
+
+    def on_error(err, idx, char, line, column, function_name=None):
+        nonlocal error
+        error = {"type": type(err).__name__, "message": str(err), "index": idx, "instruction": char,
+                 "line": line, "column": column, "function": function_name}
+
+    start = time.perf_counter()
+    try:
+        try:
+            # interpret keeps to the time limit itself, the alarm is for single instructions that take far too long
+            if timeout and hasattr(signal, "setitimer"):
+                signal.setitimer(signal.ITIMER_REAL, timeout + 1)
+            result = interpret(program, Input.from_text(text), lambda val: output.append(str(val)),
+                               max_steps=max_steps, time_limit=timeout, max_stack_size=max_stack_size,
+                               on_error=on_error, **options)
+        finally:
+            if timeout and hasattr(signal, "setitimer"):
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    except CaseTimeout:
+        result = False
+        error = {"type": "Timeout", "message": "program ran for more than {} seconds".format(timeout)}
+    # one case breaking the interpreter shouldn't take the rest of the batch with it
+    except Exception as err:
+        result = False
+        error = {"type": type(err).__name__, "message": str(err)}
+    return {"case": name, "stdout": "".join(output), "status": int(not result), "error": error,
+            "elapsed": time.perf_counter() - start}
+
+
+# each line of cases is a JSON string to use as the input, or an object with the input
+# and optionally an id, timeout, max_steps and max_stack_size overriding the defaults for that case
+def run_batch(program, cases, output=sys.stdout, *, jobs=None, timeout=None, max_steps=None, max_stack_size=None):
+    batch = []
+    for number, line in enumerate(cases):
+        if not line.strip():
+            continue
+        case = json.loads(line)
+        if isinstance(case, str):
+            case = {"input": case}
+        batch.append((case.get("id", number), case.get("input", ""), case.get("timeout", timeout),
+                      case.get("max_steps", max_steps), case.get("max_stack_size", max_stack_size)))
+    # compiled before the workers start, so none of them has to, optimized for the cases without a step limit
+    program.instructions()
+    program.instructions(False, 2)
+    jobs = jobs or os.cpu_count() or 1
+    with multiprocessing.Pool(jobs, initializer=start_batch_worker, initargs=(program,)) as pool:
+        for result in pool.imap(run_case, batch, chunksize=max(1, min(64, len(batch) // (jobs * 8)))):
+            print(json.dumps(result), file=output, flush=True)
+
+
+# server mode answers requests sent as JSON lines over a socket, running them in a pool of worker processes
+# that each keep the programs they ran last compiled
+
+served_programs = 64
+server_options = None
+server_programs = None
+server_cache = None
+
+
+def start_server_worker(options, cache):
+    global server_options, server_programs, server_cache
+    start_batch_worker(None)
+    server_options = options
+    server_programs = collections.OrderedDict()
+    server_cache = cache
+
+
+# the compiled program for source, from the worker's own programs, the cache directory, or compiled now
+def served_program(source):
+    program = server_programs.pop(source, None)
+    if program is None and server_cache is not None:
+        program = server_cache.load(source)
+    if program is None:
+        program = compile(source)
+    server_programs[source] = program
+    if len(server_programs) > served_programs:
+        server_programs.popitem(last=False)
+    return program
+
+
+# a request is an object with the source of a program, or the path to one as program, and optionally an id, input,
+# timeout, max_steps and max_stack_size, its result is the same as a batch case's
+def serve_request(line):
+    start = time.perf_counter()
+    name = None
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("a request has to be a JSON object")
+        name = request.get("id")
+        if "source" in request:
+            source = request["source"]
+        else:
+            with open(request["program"], encoding="utf-8") as file:
+                source = file.read()
+        program = served_program(source)
+    except (ParseError, ValueError, KeyError, TypeError, OSError) as err:
+        return {"case": name, "stdout": "", "status": 1, "error": {"type": type(err).__name__, "message": str(err)},
+                "elapsed": time.perf_counter() - start}
+    timeout, max_steps, max_stack_size, options = server_options
+    result = run_case((name, request.get("input", ""), request.get("timeout", timeout),
+                       request.get("max_steps", max_steps), request.get("max_stack_size", max_stack_size)),
+                      program, **options)
+    if server_cache is not None:
+        server_cache.store(program)
+    return result
+
+
+class ServerHandler(socketserver.StreamRequestHandler):
+
+    # requests on one connection run at the same time, but their results are written in the order they came in
+    def handle(self):
+        results = queue.Queue()
+        writer = threading.Thread(target=self.write_results, args=(results,))
+        writer.start()
+        try:
+            for line in self.rfile:
+                if line.strip():
+                    results.put(self.server.pool.apply_async(serve_request, (line,)))
+        finally:
+            results.put(None)
+            writer.join()
+
+    def write_results(self, results):
+        while True:
+            pending = results.get()
+            if pending is None:
+                return
+            result = pending.get()
+            try:
+                self.wfile.write(json.dumps(result).encode("utf-8") + b"\n")
+            except OSError:
+                # the client is gone, the rest of its requests still have to finish
+                pass
+
+
+# address is host:port to listen on TCP, or otherwise the path of a Unix socket
+# timeout, max_steps and max_stack_size are the defaults for requests, other options are passed on to interpret
+def serve(address, *, jobs=None, cache=None, timeout=None, max_steps=None, max_stack_size=None, **options):
+    # the workers start before the socket is opened, so they don't hold on to it
+    with multiprocessing.Pool(jobs or os.cpu_count() or 1, initializer=start_server_worker,
+                              initargs=((timeout, max_steps, max_stack_size, options), cache)) as pool:
+        if ":" in address:
+            host, port = address.rsplit(":", 1)
+            server = socketserver.ThreadingTCPServer((host or "localhost", int(port)), ServerHandler)
+        else:
+            server = socketserver.ThreadingUnixStreamServer(address, ServerHandler)
+        server.daemon_threads = True
+        server.pool = pool
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if ":" not in address:
+                os.remove(address)
+
+
+# runs the program on the same input with the interpreter and the Python backend, writing out what the interpreter
+# output and, when they differ in it, the exit status or the error, what each of them did
+# returns whether they did the same
+def compare_backends(program, text, output=sys.stdout, **options):
+    results = []
+    for backend in ("interpreter", "py"):
+        collected = []
+        error = None
+
+        def on_error(err, idx, char, line, column, function_name=None):
+            nonlocal error
+            error = {"type": type(err).__name__, "message": str(err), "index": idx, "instruction": char,
+                     "line": line, "column": column, "function": function_name}
+
+        try:
+            result = interpret(program, Input.from_text(text), lambda val: collected.append(str(val)),
+                               on_error=on_error, backend=backend, **options)
+        except Exception as err:
+            result = False
+            error = {"type": type(err).__name__, "message": str(err)}
+        results.append({"backend": backend, "stdout": "".join(collected), "status": int(not result), "error": error})
+    output.write(results[0]["stdout"])
+    if results[0] == dict(results[1], backend="interpreter"):
+        return True
+    for result in results:
+        print(json.dumps(result), file=sys.stderr)
+    return False
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a whole number, got {!r}".format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError("expected a number of at least 1, got {}".format(number))
+    return number
+
+
+def flush_policy(value):
+    if value in ("always", "newline", "input", "never"):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected always, newline, input, never or a number of characters")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="File to interpret.", nargs="?")
+    parser.add_argument(
+        "-d", "--debug", help="Output additional debug information.", action="store_true")
+    parser.add_argument(
+        "-s", "--slow", help="Go through the program step-by-step.", action="store_true")
+    parser.add_argument(
+        "-i", "--input", help="Input for the program. If not given, you will be prompted if the program requires input.")
+    parser.add_argument(
+        "-if", "--input-file", help="File to read the input for the program from, instead of standard input.")
+    parser.add_argument(
+        "-t", "--time", help="Time to wait between each execution tick.", type=float)
+    parser.add_argument(
+        "-ti", "--timeit", help="Time the program and output how long it took to finish execution.", action="store_true")
+    parser.add_argument("-ni", "--no-input",
+                        help="Don't prompt for input, no matter what.", action="store_true")
+    parser.add_argument(
+        "--flush", help="When to write out buffered output: always, newline, input (when waiting for input or time), never, "
+        "or after a number of characters. Defaults to newline on a terminal and input otherwise.", type=flush_policy)
+    parser.add_argument(
+        "--profile", help="Count and time every instruction, loop and function, and print a report of the hottest ones.",
+        action="store_true")
+    parser.add_argument(
+        "--profile-json", help="Profile the program and write the full profile to this file as JSON.")
+    parser.add_argument(
+        "--trace", help="Write a binary trace of every step to this file, which lytrace.py can rebuild the state from.")
+    parser.add_argument(
+        "--trace-sample", help="Only trace every this many steps.", type=positive_int, default=1)
+    parser.add_argument(
+        "--trace-ring", help="Only keep the last this many trace records, and write them out at the end.",
+        type=positive_int)
+    parser.add_argument(
+        "--max-steps", help="Stop the program after this many instructions.", type=int)
+    parser.add_argument(
+        "--timeout", help="Stop the program after this many seconds.", type=float)
+    parser.add_argument(
+        "--max-stack-size", help="Stop the program once its stacks hold more than this many values.", type=int)
+    parser.add_argument(
+        "-O", help="Optimization level: 0 runs every instruction as written, 1 folds literals and prints literal strings "
+        "at once, 2 (the default) also fuses common loops and comparisons.", dest="optimization", type=int,
+        choices=range(3), default=2)
+    parser.add_argument(
+        "--backend", help="Run the program one instruction at a time with the interpreter (the default), or as "
+        "Python code made from it with py.", choices=("interpreter", "py"), default="interpreter")
+    parser.add_argument(
+        "--compare-backends", help="Run the program with both backends on the same input, and report any difference "
+        "in their output, exit status or error.", action="store_true")
+    parser.add_argument(
+        "--memoize", help="Remember the results of calls to functions that only work on the stacks, and reuse them "
+        "for calls with the same arguments.", action="store_true")
+    parser.add_argument(
+        "--memoize-size", help="Number of calls --memoize keeps. Defaults to 4096.", type=positive_int, default=4096)
+    parser.add_argument(
+        "--compact-stacks", help="Keep stacks in arrays of 64 bit integers while the values fit, using far less memory.",
+        action="store_true")
+    parser.add_argument(
+        "--batch", help="Run the program once for every case in this file (- for standard input), one JSON string "
+        "or object with an input per line, writing a JSON result for each.")
+    parser.add_argument(
+        "--cache", help="Keep compiled programs in ~/.cache/ly, so running the same program again skips compiling it.",
+        action="store_true")
+    parser.add_argument(
+        "--cache-dir", help="Keep compiled programs in this directory instead, which implies --cache.")
+    parser.add_argument(
+        "--cache-size", help="Most megabytes the cache directory may take up before the least recently used programs "
+        "are removed. Defaults to 64.", type=float, default=64)
+    parser.add_argument(
+        "--serve", help="Instead of running a file, answer requests to run programs, one JSON object per line, on this "
+        "Unix socket, or on host:port over TCP.")
+    parser.add_argument(
+        "-j", "--jobs", help="Number of processes to run batch cases or served requests in. Defaults to the number of "
+        "cores.", type=int)
+    args = parser.parse_args(argv)
+    if args.cache and args.cache_dir is None:
+        args.cache_dir = default_cache_dir()
+    profile = Profile() if args.profile or args.profile_json else None
+    if profile is not None and (args.debug or args.slow or args.time):
+        parser.error("profiling can't be combined with --debug, --slow or --time")
+    if args.trace is not None and (profile is not None or args.debug or args.slow or args.time):
+        parser.error("tracing can't be combined with profiling, --debug, --slow or --time")
+
+    if args.serve is not None:
+        cache = None
+        if args.cache_dir is not None:
+            cache = ProgramCache(args.cache_dir, max_size=int(args.cache_size * 1024 * 1024))
+        serve(args.serve, jobs=args.jobs, cache=cache, timeout=args.timeout, max_steps=args.max_steps,
+              max_stack_size=args.max_stack_size, compact_stacks=args.compact_stacks, optimization=args.optimization,
+              backend=args.backend)
+        return 0
+    if args.filename is None:
+        parser.error("the following arguments are required: filename")
+
+    try:
+        with open(args.filename, encoding="utf-8") as file:
+            source = file.read()
+    except FileNotFoundError:
+        print("That file couldn't be found.")
+        return 1
+
+    cache = None
+    program = None
+    if args.cache_dir is not None:
+        cache = ProgramCache(args.cache_dir, max_size=int(args.cache_size * 1024 * 1024))
+        program = cache.load(source)
+    if program is None:
+        try:
+            program = compile(source)
+        except ParseError as err:
+            print("Error occurred during parsing", file=sys.stderr)
+            print("SyntaxError: " + str(err), file=sys.stderr)
+            return 1
+
+    if args.batch is not None:
+        try:
+            cases = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8")
+        except FileNotFoundError:
+            print("That batch file couldn't be found.")
+            return 1
+        with cases:
+            run_batch(program, cases, jobs=args.jobs, timeout=args.timeout, max_steps=args.max_steps,
+                      max_stack_size=args.max_stack_size)
+        if cache is not None:
+            cache.store(program)
+        return 0
+
+    if args.compare_backends:
+        if args.no_input:
+            text = ""
+        elif args.input is not None:
+            text = args.input
+        elif args.input_file is not None:
+            try:
+                with open(args.input_file, encoding="utf-8") as file:
+                    text = file.read()
+            except FileNotFoundError:
+                print("That input file couldn't be found.")
+                return 1
+        else:
+            text = sys.stdin.read()
+        same = compare_backends(program, text, time_limit=args.timeout, max_stack_size=args.max_stack_size,
+                                compact_stacks=args.compact_stacks, optimization=args.optimization)
+        if cache is not None:
+            cache.store(program)
+        return 0 if same else 1
+
+    total_output = []
+    if not args.debug:
+        if args.flush is None:
+            args.flush = "newline" if sys.stdout.isatty() else "input"
+        normal_execution = Output(sys.stdout, flush=args.flush)
     else:
-        output_function(" ".join([str(x) for x in stack]))
-    return True
+        def normal_execution(val):
+            print("outputted: " + str(val))
+            total_output.append(str(val))
+    if args.no_input:
+        input_function = lambda: ""
+    elif args.input is not None:
+        input_function = Input.from_text(args.input)
+    elif args.input_file is not None:
+        try:
+            input_function = Input.from_path(args.input_file)
+        except FileNotFoundError:
+            print("That input file couldn't be found.")
+            return 1
+    elif args.slow:
+        # stepping reads standard input a line at a time as well
+        input_function = input
+    else:
+        input_function = Input(sys.stdin)
+    trace = None
+    if args.trace is not None:
+        trace = Trace(open(args.trace, "wb"), sample=args.trace_sample, ring_size=args.trace_ring)
+    start = time.time()
+    try:
+        _, status = program.run(input_function, normal_execution, debug=args.debug,
+                                delay=args.time, step_by_step=args.slow, max_steps=args.max_steps,
+                                time_limit=args.timeout, max_stack_size=args.max_stack_size, profile=profile,
+                                trace=trace, compact_stacks=args.compact_stacks, optimization=args.optimization,
+                                backend=args.backend, memoize=args.memoize_size if args.memoize else 0)
+    finally:
+        if not args.debug:
+            normal_execution.close()
+        if trace is not None:
+            trace.close()
+            trace.file.close()
+    end = time.time()
+    if cache is not None:
+        cache.store(program)
+    if profile is not None and profile.program is not None:
+        if args.profile:
+            print(profile.report(), file=sys.stderr)
+        if args.profile_json:
+            with open(args.profile_json, "w", encoding="utf-8") as file:
+                json.dump(profile.to_json(), file, indent=2)
+    if args.timeit:
+        print("\nTotal execution time in seconds: " + str(end - start))
+    if args.debug:
+        print("\nTotal output: " + "".join(total_output))
+    return status
 
 
-if not args.debug:
-    def normal_execution(val):
-        print(str(val), end="", flush=True)
-else:
-    total_output = ""
-
-    def normal_execution(val):
-        global total_output
-        print("outputted: " + str(val))
-        total_output += str(val)
-start = time.time()
-result = interpret(preprocessed_program, input if not args.no_input else lambda: "", normal_execution, debug=args.debug,
-          delay=args.time, step_by_step=args.slow)
-end = time.time()
-if args.timeit:
-    print("\nTotal execution time in seconds: " + str(end - start))
-if args.debug:
-    print("\nTotal output: " + total_output)
-
-sys.exit(int(not result))
+if __name__ == "__main__":
+    sys.exit(main())
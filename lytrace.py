@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# Rebuilds the state of a Ly program at any step from a trace written by ly.py --trace
+
+import argparse
+import marshal
+import sys
+
+
+def records(file):
+    while True:
+        try:
+            yield marshal.load(file)
+        except EOFError:
+            return
+
+
+# returns the last recorded step up to step (or the last step at all), the index and instruction of it,
+# and the state after it, one [stacks, stack pointer, backup] for the program and each function it was running
+def replay(file, step=None):
+    header = marshal.load(file)
+    if header[0] != "ly-trace":
+        raise ValueError("not a Ly trace")
+    _, version, sample, ring = header
+    contents = {}
+    levels = []
+    last = None
+    # a ring has lost the records before its first keyframe
+    started = not ring
+    for record in records(file):
+        if record[0] == "keyframe":
+            _, at, keyframe_levels, keyframe_contents = record
+            if step is not None and at > step:
+                break
+            contents = {number: list(values) for number, values in keyframe_contents.items()}
+            levels = [list(level) for level in keyframe_levels]
+            started = True
+            continue
+        at, depth, idx, char, order, pointer, changed, backup, deltas = record
+        if not started:
+            continue
+        if step is not None and at > step:
+            break
+        for number, keep, values in deltas:
+            contents.setdefault(number, [])[keep:] = values
+        del levels[depth + 1:]
+        while len(levels) <= depth:
+            levels.append([(), 0, None])
+        if order is not None:
+            levels[depth][0] = order
+        levels[depth][1] = pointer
+        if changed:
+            levels[depth][2] = backup
+        last = (at, idx, char)
+    if last is None:
+        raise ValueError("no recorded step at or before {}".format(step))
+    state = [[[contents.get(number, []) for number in order], pointer, list(backup) if type(backup) == tuple else backup]
+             for order, pointer, backup in levels]
+    return last, state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the state of a traced Ly program at a step.")
+    parser.add_argument("trace", help="Trace file written by ly.py --trace.")
+    parser.add_argument("step", help="Step to show the state after. Defaults to the last one.", type=int, nargs="?")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.trace, "rb") as file:
+            (at, idx, char), state = replay(file, args.step)
+    except FileNotFoundError:
+        print("That trace couldn't be found.")
+        return 1
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+
+    print("step {}{}, index {}, instruction {}".format(
+        at, "" if args.step is None or at == args.step else " (the last one recorded)", idx, char or "(end)"))
+    for depth, (stacks, pointer, backup) in enumerate(state):
+        print("{}: stacks {}, pointer {}, backup {}".format(
+            "program" if depth == 0 else "function " + str(depth), stacks, pointer, backup))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,434 @@
+import asyncio
+import io
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import ly
+import lytrace
+
+
+# a ( ) without a number in it is skipped as a whole, the inside isn't instructions
+@pytest.mark.parametrize("source, output", [
+    ("1(u)", "1"),
+    ("1 (x)", "1"),
+    ("1(u)2", "1 2"),
+    ("( )1[1-]", "0"),
+])
+def test_empty_number_is_skipped(source, output):
+    for optimization in (0, 1, 2):
+        assert ly.compile(source).run(optimization=optimization) == (output, 0)
+
+
+# what the original interpreter outputs for these, with 4, 5 and 6 as the input
+@pytest.mark.parametrize("source, output", [
+    ("(10)[:u1-]", "109876543210"),
+    ('"hello"&o', "hello"),
+    ("5R&+u", "9"),
+    ("3:*u", "9"),
+    ("12+34*-u", "-9"),
+    ("1 2 3r&u", "3\n2\n1"),
+    ("(7)(3)%u", "1"),
+    ("1>2>3<<&u", "1"),
+    ("1s>lu", "1"),
+    ("(5)R2~u", "04 5"),
+    ("0[1]3u", "30"),
+    ("65o66o", "\x05\x066 6"),
+    ("'a'bfoo", "ab"),
+    ("(3)[p]1u", "1"),
+    ("1 2=u", "01"),
+    ("9 3/u", "3.0"),
+    ("ni&+u", "57"),
+    ("&nau", "64 5"),
+])
+@pytest.mark.parametrize("options", [
+    {"optimization": 0}, {"optimization": 2}, {"backend": "py"}, {"compact_stacks": True}, {"memoize": 16},
+])
+def test_matches_original(source, output, options):
+    assert ly.compile(source).run("4\n5\n6", **options) == (output, 0)
+
+
+# a sampled trace still has what a caller did in the steps it skipped, once a function runs
+@pytest.mark.parametrize("source", ["x{1+}17sx", "x{1+}1>x", "x{1+}1x2s>x"])
+@pytest.mark.parametrize("sample", [2, 3])
+def test_sampled_trace_keeps_callers(source, sample):
+    program = ly.compile(source)
+    files = {}
+    for every in (1, sample):
+        files[every] = io.BytesIO()
+        program.run(trace=ly.Trace(files[every], sample=every))
+    steps = 0
+    while True:
+        try:
+            (at, _, _), _ = lytrace.replay(io.BytesIO(files[1].getvalue()), steps + 1)
+        except ValueError:
+            break
+        if at != steps + 1:
+            break
+        steps += 1
+    for step in range(sample, steps + 1, sample):
+        assert (lytrace.replay(io.BytesIO(files[sample].getvalue()), step)
+                == lytrace.replay(io.BytesIO(files[1].getvalue()), step))
+
+
+@pytest.mark.parametrize("value", ["0", "-2", "x"])
+def test_trace_sample_must_be_positive(value, tmp_path, capsys):
+    path = tmp_path / "program.ly"
+    path.write_text("1u")
+    with pytest.raises(SystemExit) as exit:
+        ly.main([str(path), "--trace", str(tmp_path / "trace"), "--trace-sample", value])
+    assert exit.value.code == 2
+    assert "--trace-sample" in capsys.readouterr().err
+
+
+# a bare --cache can't take the program as its directory
+def test_cache_switch(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    path = tmp_path / "program.ly"
+    path.write_text("1 2+u")
+    for _ in range(2):
+        assert ly.main(["--cache", "-ni", str(path)]) == 0
+        assert capsys.readouterr().out.startswith("3")
+    assert len(os.listdir(tmp_path / "cache" / "ly")) == 1
+    assert ly.main(["--cache-dir", str(tmp_path / "other"), "-ni", str(path)]) == 0
+    assert len(os.listdir(tmp_path / "other")) == 1
+
+
+# a bare --memoize can't take the program as its size
+def test_memoize_switch(tmp_path, capsys):
+    path = tmp_path / "program.ly"
+    path.write_text("x{1+u}3x3x")
+    assert ly.main(["--memoize", "-ni", str(path)]) == 0
+    assert ly.main([str(path), "-ni", "--memoize", "--memoize-size", "1"]) == 0
+    assert capsys.readouterr().out == "4 4" * 2
+
+
+# one result line per case in the order of the cases, a case's own limits overriding the batch's
+def test_run_batch():
+    cases = [
+        '"3"',
+        '{"id": "loop", "input": "-1", "timeout": 0.5, "max_steps": null}',
+        '{"id": "steps", "input": "100", "max_steps": 10}',
+        '',
+        '{"id": "text", "input": "x"}',
+        '{"input": "2"}',
+    ]
+    output = io.StringIO()
+    ly.run_batch(ly.compile("n[1-]u"), cases, output, jobs=2, max_steps=1000)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [result["case"] for result in results] == [0, "loop", "steps", "text", 5]
+    assert [(result["stdout"], result["status"]) for result in results] == [
+        ("0", 0), ("", 1), ("", 1), ("", 1), ("0", 0)]
+    assert results[0]["error"] is None
+    assert results[1]["error"]["type"] == "TimeLimitError"
+    assert results[1]["error"]["message"] == "program ran for more than 0.5 seconds"
+    assert results[2]["error"]["type"] == "StepLimitError"
+    assert results[2]["error"]["message"] == "program ran for more than 10 instructions"
+    assert results[3]["error"] == {"type": "InputError", "message": "program expected integer input, got string instead",
+                                   "index": 0, "instruction": "n", "line": 1, "column": 1, "function": None}
+
+
+# results come back in the order the requests were sent, even when an earlier one takes longer
+def test_serve(tmp_path, monkeypatch):
+    servers = []
+
+    class Server(ly.socketserver.ThreadingUnixStreamServer):
+        def __init__(self, *args):
+            super().__init__(*args)
+            servers.append(self)
+
+    monkeypatch.setattr(ly.socketserver, "ThreadingUnixStreamServer", Server)
+    address = str(tmp_path / "socket")
+    thread = threading.Thread(target=ly.serve, args=(address,), kwargs={"jobs": 2, "max_steps": 1000})
+    thread.start()
+    try:
+        while not servers:
+            time.sleep(0.01)
+        path = tmp_path / "program.ly"
+        path.write_text("n2*u")
+        requests = [
+            {"id": "slow", "source": "(20000)[1-]u", "max_steps": None},
+            {"id": "path", "program": str(path), "input": "7"},
+            {"id": "bracket", "source": "1[u"},
+            "not json",
+            [1, 2],
+            {"id": "steps", "source": "1[1]"},
+        ]
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(address)
+            client.sendall(b"".join((line if isinstance(line, str) else json.dumps(line)).encode() + b"\n"
+                                    for line in requests))
+            client.shutdown(socket.SHUT_WR)
+            with client.makefile() as lines:
+                results = [json.loads(line) for line in lines]
+    finally:
+        if servers:
+            servers[0].shutdown()
+        thread.join()
+    assert [result["case"] for result in results] == ["slow", "path", "bracket", None, None, "steps"]
+    assert [(result["stdout"], result["status"]) for result in results] == [
+        ("0", 0), ("14", 0), ("", 1), ("", 1), ("", 1), ("", 1)]
+    assert results[2]["error"]["type"] == "ParseError"
+    assert results[3]["error"]["type"] == "JSONDecodeError"
+    assert results[4]["error"] == {"type": "ValueError", "message": "a request has to be a JSON object"}
+    assert results[5]["error"]["type"] == "StepLimitError"
+    assert not os.path.exists(address)
+
+
+def cached(cache, source):
+    program = ly.compile(source)
+    assert program.run() == (source[0], 0)
+    assert cache.store(program)
+    return cache.path(source)
+
+
+# a program stored by another interpreter, or another version of this one, is compiled again
+def test_cache_is_keyed_by_interpreter(tmp_path, monkeypatch):
+    cache = ly.ProgramCache(str(tmp_path))
+    path = cached(cache, "1u")
+    assert cache.load("1u").run() == ("1", 0)
+    monkeypatch.setattr(ly, "interpreter_hash", "0" * 64)
+    assert cache.path("1u") != path
+    assert cache.load("1u") is None
+    cached(cache, "1u")
+    assert len(os.listdir(tmp_path)) == 2
+
+
+# the files used longest ago are the ones removed, and loading one counts as using it
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ly.ProgramCache(str(tmp_path))
+    paths = [cached(cache, source) for source in ("1u", "2u", "3u")]
+    for age, path in enumerate(paths):
+        os.utime(path, (1000 + age, 1000 + age))
+    assert cache.load("1u") is not None
+    size = os.path.getsize(paths[0])
+    assert {os.path.getsize(path) for path in paths} == {size}
+    cache.max_size = 2 * size
+    latest = cached(cache, "4u")
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(path) for path in (paths[0], latest))
+
+
+# running with a smaller size evicts even when the program has nothing new to store
+def test_cache_evicts_when_unchanged(tmp_path, capsys):
+    path = tmp_path / "program.ly"
+    path.write_text("1 2+u")
+    assert ly.main(["--cache-dir", str(tmp_path / "cache"), "-ni", str(path)]) == 0
+    assert len(os.listdir(tmp_path / "cache")) == 1
+    assert ly.main(["--cache-dir", str(tmp_path / "cache"), "--cache-size", "0", "-ni", str(path)]) == 0
+    assert os.listdir(tmp_path / "cache") == []
+    assert capsys.readouterr().out.startswith("3")
+
+
+# with a threshold of 4 every R below makes a RangeStack, which has to do what the plain stack does
+@pytest.mark.parametrize("source", [
+    "1(10)Ruuu&u",
+    "1(10)R5u&u",
+    "1(10)Rr&u",
+    "1(10)Rr3u&u",
+    "1(10)Rruu&u",
+    "1(10)Rra&u",
+    "1(10)R0 9Ra&u",
+    "1(10)Rr(10)1Ra&u",
+    "1(10)R2 7W&u",
+    "1(10)R2 7Wa&u",
+    "1(10)R3I&u",
+    "1(10)R0I&u",
+    "1(10)R(20)I&u",
+    "1(10)R&+u",
+    "9 2/1(10)R&+u",
+    "1(10)R9 2/1(10)R&+u",
+    "1(10)R(99)(99)^1(10)R&+u",
+    "1(10)R(99)(99)^9 2/*&+u",
+    "1(10)R(99)(99)^9 2/1(10)R&+u",
+    "1(10)R&:&+u",
+    "1(10)R&sl&u",
+    "1(10)R&s5l&u",
+    "1(10)R&s>ll&u",
+    "1(10)R0 3[p]&u",
+    "1(10)R4 2~u(11)~u",
+    "1(10)R&p1u",
+])
+def test_range_stack(source, monkeypatch):
+    expected = ly.compile(source).run()
+    monkeypatch.setattr(ly, "range_threshold", 4)
+    assert ly.compile(source).run() == expected
+
+
+# copying a range keeps it a range, instead of a list of all its values
+def test_range_stack_copies():
+    assert ly.compile("1(10000000)R&sl&:&+u").run() == ("200000020000000", 0)
+
+
+# a coroutine giving out lines one per call, after a delay, and then EOFError
+def delayed_lines(*lines, delay=0.01):
+    calls = []
+
+    async def read():
+        calls.append(len(calls))
+        await asyncio.sleep(delay)
+        if len(calls) > len(lines):
+            raise EOFError
+        return lines[len(calls) - 1]
+    return read, calls
+
+
+# an instruction that needs input that hasn't arrived runs again once it has, with the values it took put back
+@pytest.mark.parametrize("source, lines, output", [
+    ("nn+u", ("4", "5"), "9"),
+    ("1+u", ("4",), "5"),
+    ("+u", ("3", "4"), "7"),
+    ("1 2n-+u", ("3",), "0"),
+    ("i&o", ("ab",), "ab"),
+    ("n+u", ("3",), "3"),
+])
+def test_async_input_arrives_later(source, lines, output):
+    read, _ = delayed_lines(*lines)
+    assert asyncio.run(ly.compile(source).run_async(read, interval=1)) == (output, 0)
+    assert asyncio.run(ly.compile(source).run_async("\n".join(lines))) == (output, 0)
+
+
+# &n waits for every line up to the end of the input before any of them go onto the stack
+def test_async_read_numbers():
+    read, calls = delayed_lines("1", "2", "3")
+    assert asyncio.run(ly.compile("&n&+u").run_async(read)) == ("6", 0)
+    assert len(calls) == 4
+    read, calls = delayed_lines("1", "2", "", "4")
+    assert asyncio.run(ly.compile("&n&+un&+u").run_async(read)) == ("34", 0)
+    read, _ = delayed_lines("1", "x")
+    assert asyncio.run(ly.compile("&n&+u").run_async(read, on_error=lambda *report: None)) == ("", 1)
+
+
+# while one program waits, others run
+def test_async_wait():
+    events = []
+
+    async def output(val):
+        events.append(val)
+
+    async def other():
+        await asyncio.sleep(0.05)
+        events.append("other")
+
+    async def both():
+        await asyncio.gather(ly.compile("15/w2u").run_async(output=output), other())
+
+    asyncio.run(both())
+    assert events[:2] == ["other", 2]
+
+
+# what a run output, whether it succeeded and the errors it reported, to compare runs by
+def outcome(source, text="", **options):
+    output, errors = [], []
+    result = ly.interpret(ly.compile(source), ly.Input.from_text(text), lambda val: output.append(str(val)),
+                          on_error=lambda err, *where: errors.append((type(err).__name__, str(err)) + where), **options)
+    return "".join(output), result, errors
+
+
+# a compact stack turns into a list for a value that doesn't fit in 64 bits, and its errors read like a list's
+@pytest.mark.parametrize("source, text", [
+    ("12(99)(99)^pp&u", ""),
+    ("(99)(99)^:*&+u", ""),
+    ("12 9 2/3a&u", ""),
+    ("1 2(99)(99)^&s>l&u", ""),
+    ("1 2(99)(99)^&s>3l&u", ""),
+    ("&n&u", "1\n2\n99999999999999999999\n3"),
+    ("&n&u", "1\n2\n-9223372036854775809"),
+    ("&n&u", "1\n9223372036854775807"),
+    ("(9223372036854775805)(9223372036854775809)R&u", ""),
+    ("1 2(20)I", ""),
+    ("1 2(3)NI", ""),
+    ("1 2(99)(99)^I", ""),
+    ("1 2(99)(99)^NI", ""),
+    ("1 2 5 0W", ""),
+    ("1 2 0 5W", ""),
+    ("1 2 0(99)(99)^W", ""),
+])
+def test_compact_stack(source, text):
+    assert outcome(source, text, compact_stacks=True) == outcome(source, text)
+
+
+def test_compact_stack_promotes():
+    assert ly.compile("1 2(9223372036854775807)`&u").run(compact_stacks=True) == ("1\n2\n9223372036854775808", 0)
+    # the values of a partly failed extend aren't left behind
+    assert ly.compile("1 2(99)(99)^&s>3l&+u").run(compact_stacks=True) == (str(3 + 3 + 99 ** 99), 0)
+
+
+# once ~ starts counting a long stack's values, the counts have to follow every change made to it
+@pytest.mark.parametrize("compact_stacks", [False, True])
+def test_counted_stack(compact_stacks, monkeypatch):
+    queries = "(300)~u1~u(299)~u(301)~u(500)~u0~u7~u(700)~u(800)~u"
+    source = "".join([
+        "1(300)R0~p", queries,
+        "0(299)W", queries,
+        "(500)f", queries,
+        "`", queries,
+        ",,", queries,
+        "a", queries,
+        "r", queries,
+        "(300)s1l", queries,
+        "0(700)(800)[p]p", queries,
+        "(9)(99)^", queries,
+        "9 2/0~", queries,
+        "&p", queries,
+        "(400)~u1(300)R0~p7", queries,
+    ])
+    counted = outcome(source, compact_stacks=compact_stacks)
+    monkeypatch.setattr(ly, "count_threshold", 1 << 30)
+    assert counted == outcome(source, compact_stacks=compact_stacks)
+    assert counted[1]
+
+
+def read_all(read_line):
+    lines = []
+    while True:
+        try:
+            lines.append(read_line())
+        except EOFError:
+            return lines
+
+
+text_lines = "ab\r\ncdé\n\nfg\rh\r\n12345"
+expected_lines = ["ab", "cdé", "", "fg", "h", "12345"]
+
+
+# lines, a \r\n and characters split across blocks come out whole
+@pytest.mark.parametrize("block_size", [1, 2, 3, 5, 1 << 16])
+def test_input_blocks(block_size):
+    assert read_all(ly.Input(io.BytesIO(text_lines.encode()), block_size=block_size)) == expected_lines
+    assert read_all(ly.Input.from_text(text_lines)) == expected_lines
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 1 << 20])
+def test_input_mmap(block_size, tmp_path, monkeypatch):
+    path = tmp_path / "input"
+    path.write_bytes(text_lines.encode())
+    mapped = []
+    mmap = ly.mmap.mmap
+    monkeypatch.setattr(ly.mmap, "mmap", lambda *args, **kwargs: mapped.append(args) or mmap(*args, **kwargs))
+    assert read_all(ly.Input.from_path(str(path), block_size=block_size)) == expected_lines
+    assert not mapped
+    monkeypatch.setattr(ly.Input, "mmap_size", 1)
+    assert read_all(ly.Input.from_path(str(path), block_size=block_size)) == expected_lines
+    assert len(mapped) == 1
+
+
+# numbers stops after the line that isn't one, or after the empty line ending the run, and leaves the rest
+@pytest.mark.parametrize("block_size", [1, 2, 3, 5, 1 << 16])
+def test_input_numbers(block_size):
+    read_line = ly.Input(io.BytesIO(b"10\n20\r\n300\nx\n4\n"), block_size=block_size)
+    assert read_line.numbers() == ([10, 20, 300], False)
+    assert read_all(read_line) == ["4"]
+    read_line = ly.Input(io.BytesIO(b"10\n-20\r\n300\n\n4\n5"), block_size=block_size)
+    assert read_line.numbers() == ([10, -20, 300], True)
+    assert read_line.numbers() == ([4, 5], True)
+    assert read_line.numbers() == ([], True)
+    read_line = ly.Input(io.BytesIO(b"x\n1"), block_size=block_size)
+    assert read_line.numbers() == ([], False)
+    assert read_line() == "1"